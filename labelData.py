@@ -6,9 +6,48 @@
 import subprocess
 import sys
 import os
+import io
+import contextlib
 
 configFile = "sensorcodeConfigFile.txt"
 
+# csv input files larger than 'streamSizeLimit' (MB) are read in chunks of 'chunkSize' records, rather than all at once
+streamSizeLimit = 500
+chunkSize = 500000
+# Compressed csv input files are taken to be 'compressedSizeFactor' times their size on disk when deciding whether to read them in chunks
+compressedSizeFactor = 5
+# Purposes that process the chunks of a large input file one at a time, rather than joining them together first. For all other purposes the processed
+# chunks are joined into 'df', so the data kept from a large file (after column selection and downsampling) still has to fit in memory.
+streamPurposes = ["SHOW HISTOGRAM","COMBINE"]
+
+# Loaded input files are cached in this folder (created in the folder containing the input file), up to a total size of 'cacheBudget' MB
+cacheFolder = "labelDataCache"
+cacheBudget = 2000
+
+# Number of recordings labelled at the same time when labelling a folder of recordings from their annotations files (None for one per processor)
+labelWorkers = None
+# Number of input files read at the same time when combining files listed in a text file or matching a pattern (None for one per processor)
+combineWorkers = None
+
+# Output files are kept open while a purpose is processed, and closed at the end of it. 'outputWriters' holds the open file for each output filename.
+# csv output files are written through a buffer of 'outputBufferSize' MB.
+outputWriters = {}
+outputBufferSize = 16
+
+# Derived values that can be added to labelled output records (see 'getFeatureValues'), by the code used to select them. HFEN uses a high-pass filter with a
+# cutoff of 'hfenCutoff' Hz.
+featureCodes = {'R': 'rms', 'E': 'enmo', 'H': 'hfen', 'A': 'anglez'}
+hfenCutoff = 0.2
+
+# Include the minimum and maximum of each numeric item, as well as the mean and standard deviation, in the summary file written after labelling
+summaryMinMax = False
+
+# Plots of input data show at most 'maxPlotPoints' points per variable - larger data is reduced to the minimum and maximum values in each of
+# 'maxPlotPoints'/2 blocks of records, so spikes stay visible
+maxPlotPoints = 4000
+# When a plot is zoomed or panned it is redrawn from a pyramid of minimum and maximum values, starting with blocks of 'pyramidBase' records
+pyramidBase = 64
+
 helpText = """
 
 This code has seven basic functions : 
@@ -44,12 +83,22 @@ This code has seven basic functions :
      The user can opt for both scaled and unscaled outputs - it may be useful for comparing model predictions with scaled/unscaled inputs.
      
      The user can add a 'root mean squared' value to the output file, ie the square root of the sum of the squares of selected variables.
+     For accelerometer data (x,y,z columns) they can also add ENMO (the root mean squared value minus one, or zero if negative), HFEN (the root mean squared
+     value of the x,y,z values after a high-pass filter) and angle-z (the angle of the z axis to the horizontal). These values are added before the data is
+     plotted, so they appear on the plot used for selecting time periods.
+     ENMO, HFEN and angle-z are made from the un-scaled x,y,z values, so they can't be created if those columns are scaled for the data (D) - scaling
+     for both outputs (B) keeps them un-scaled in both files. HFEN needs every reading, so it can't be created if only some readings per second are kept.
      
      The file type of the output file is set to the same as for the input file, eg if the input file is a csv file, then the output file will also be csv.
      A summary file is also produced, with '-sum' appended to the output data file name, showing the mean and standard deviation of each of the numeric 
      variables, for each distinct period with respect to the labels applied. For example, if the labels 'Walk' and 'Sit' were chosen for the first 15 minutes 
      and the second 15 minutes respectively, then the mean values (and standard deviations) are shown for numeric values over these two periods.
      A subjectid (eg person's name or initials) and a sensor location (eg left wrist or waist) can be included in the summary records.      
+     Instead of selecting periods on the plot, labels can be read from an annotations file (csv or json) with 'start', 'end' and 'label' values, start and
+     end being timestamps in the same format as the recording. Periods not covered by an annotation are labelled 'Other'. A whole folder of recordings can
+     be labelled in one run, each recording having an annotations file named '<recording name>_annotations.csv' (or .json) alongside it. The responses
+     given for the first recording are used for the rest, which are processed in parallel, and the outputs are named '<recording name>_labelled' and
+     '<recording name>_labelled_sum'.
 
   2. Combine csv/xlsx files. The user selects files to combine, and each one is appended to the output file. As for option one, the user can select specific
      columns (variables) to include, can scale values, and can specify a proportion of input records to include in the output file. After the first file has 
@@ -60,12 +109,25 @@ This code has seven basic functions :
      Input files do not need to contain the same number of columns (variables), so, for example, a file containing a timestamp and heartrate variable could be 
      appended to one cotaining a timestamp and 3 accelerometer variables. The file type of the first file determines the type of the output file, eg if the first 
      file specified is an xlsx file, then the output file will be too, although input files do not need to be of the same file type.
-
-  3. Pre-process a file containing (numerical) physiological data. A specific column containing the target data must be selected by the user. The code determines
-     the mean of the values in the selected column on a minute by minute basis (M), by blocks of numbers of seconds (S), or by blocks of data containing a specified 
+     Large csv input files are read and written a chunk at a time, so input files of any size can be combined without running out of memory. The scaling
+     of such a file would only be found from its first chunk, so large csv files can't be scaled for the data (D) when combining.
+     After the first file, the rest of the input files can be selected one at a time, listed in a text file (one per line), or given by a pattern matching
+     them (eg C:/data/night*.csv). Files from a list or pattern are combined in order using the responses given for the first file. They are read at the same
+     time by several processes, and the records and MB read per second are shown for each one.
+
+  3. Pre-process a file containing (numerical) physiological data. The columns containing the target data must be selected by the user. The code determines
+     the mean of the values in each selected column on a minute by minute basis (M), by blocks of numbers of seconds (S), or by blocks of data containing a specified 
      number of records (B). If the difference in the mean value for a given block of size M/S/B, and the mean value for the block M/S/B preceeding it by two blocks
      of size M/S/B is greater than a specific percentage (chosen by the user), then the values for the block of M/S/B immediately before the current block of M/S/B
      are set to the same as for the current block. 
+     Several columns can be selected, and several percentages can be entered (separated by commas) to compare the results. Each percentage is written either to
+     its own output file (the filename entered with '_' and the percentage added, eg heart_25.csv) or to a single output file with the percentage in an extra last
+     column.
+     Alternatively, the step changes can be found as change points (C) - the points where the mean level of the data changes - rather than by comparing blocks.
+     The values between two change points are all set to their mean value, so each change of level becomes a step change. The user chooses the minimum time
+     between change points, and a penalty (in place of the percentage) - higher penalties find fewer change points. This doesn't depend on a block size.
+     Each level of splitting takes one pass through the data - there are about log2(number of change points) levels when the data splits evenly, but up to
+     one level per change point when each split only takes a short part off one end, so data with many change points can take much longer.
      The purpose of this is to attempt to improve the accuracy of models built using this data, that predict eg human activity.
      For example, suppose a user wears two sensors, an accelerometer and a heart rate sensor. They switch between activities, eg sitting, walking, running etc and 
      the readings from the sensors are used to try to predict their activity types.
@@ -92,6 +154,8 @@ This code has seven basic functions :
       magnitudes, eg if they include heartrate and accelerometer readings, scaling will be required to produce a meaningful plot. The creation 
       of a GaussianNB machine learning model assumes input data have approximately Normal distribution; a histogram plot of the data can be used 
       to determine if this is the case. The user specifies the number of bins to use.      
+      The counts in each bin can be saved to an output file. For a large file read in chunks, the values are counted a chunk at a time (so the whole
+      file is never held in memory), and the start and end times of the data of interest can be selected from a plot of the first chunk.
     
    6, 7 and 8. Create predictive models from labelled data. kMeans, Machine learning and Neural Network models can be created using labelled input data files. 
      The user specifies the column containing the category that the model may be used to predict, and as for other options the user can choose specific columns, 
@@ -119,6 +183,17 @@ To run :
   
 Input and output files and folders are selected by the user from a separate Explorer window.  
 All input file records are required to have a timestamp as their first variable (in their first column).
+Large csv input files (over 500MB) are read in chunks of 500,000 records. Responses given for the first chunk (columns to process, scaling,
+proportion of records to keep) are applied to the rest of the file. The datetime format, the number of records per second/minute
+and the scaling are found from the first chunk only. Showing a histogram and combining files process a large file a chunk at a time; for the other
+purposes the processed chunks are joined together, so the data kept (after selecting columns and the proportion of records to keep) must fit in memory.
+Compressed csv input files (.csv.gz, .csv.zst, .csv.bz2, .csv.xz, or a .zip holding a single csv file) are read directly, without decompressing
+them to disk first. The zstandard library is needed for .csv.zst files.
+If the pyarrow library is available, a copy of each input file is cached in a fast-loading format in a folder 'labelDataCache' created in the same folder
+as the input file, and is used the next time the file is selected (provided the file has not changed). Least recently used files are removed from the
+cache when it exceeds 2000MB.
+csv output files can be written with a fixed number of decimal places, and compressed with gzip (.csv.gz) or, if the zstandard library is
+available, zstandard (.csv.zst).
 
 If an input file has potentially ambiguous month and day values (if none of the day values in the data exceed '12'), then the user may swap round the month and day
 values - this will be required if the plot of the data is clearly wrong, with values strongly clumped together on the time axis when the user would expect them to be 
@@ -137,6 +212,8 @@ The x, y and z directions will depend on the orientation of the sensor during th
 OM has a facility for exporting the resultant 'cwa' files to other file types, such as csv files.
  
 This code processes exported files (from OM) of type 'raw csv', with datetime format Y-M-D h:m:s.f, and Accelerometer Units Gravity(g). 
+'cwa' files can also be selected as input files directly, without exporting them first. The x, y and z values are read in units of gravity (g), and
+the timestamp of each reading is interpolated from the timestamps held in the file. Output files are csv files.
 
 The sensor can record between 12.5 and 500 readings per second (Hz), but the OM software warns that it may not process signals correctly if the rate
 is set below 50Hz. It is probably best therefore to use this as a minimum frequency value when configuring the sensor. However, this number of readings
@@ -204,6 +281,29 @@ def loadLibraries():
     loadLibrary("from openpyxl import load_workbook")  
     loadLibrary("from pathvalidate import ValidationError, validate_filename","pathvalidate")
     loadLibrary("from sklearn import preprocessing")
+    loadLibrary("import hashlib")
+    loadLibrary("import json")
+# pyarrow is optional - it is only used to cache input files. If it isn't available input files are read in full every time.
+    try:
+      import pyarrow as pa
+      import pyarrow.feather as feather
+      globals().update({'pa': pa, 'feather': feather})
+    except ModuleNotFoundError:
+      globals().update({'pa': None, 'feather': None})
+    loadLibrary("import gzip")
+    loadLibrary("import itertools")
+# python-calamine is optional - if it is available it is used to read xlsx input files, which is faster than openpyxl
+    try:
+      from python_calamine import CalamineWorkbook
+      globals().update({'CalamineWorkbook': CalamineWorkbook})
+    except ModuleNotFoundError:
+      globals().update({'CalamineWorkbook': None})
+# zstandard is optional - it is only used to compress csv output files
+    try:
+      import zstandard
+      globals().update({'zstandard': zstandard})
+    except ModuleNotFoundError:
+      globals().update({'zstandard': None})
     
 # AutoMinorLocator is used to change the number of minor x-axis 'ticks' (and grid lines) in the data plots
 # Here we're setting it to 15 minor ticks between each major tick
@@ -246,8 +346,20 @@ def loadLibraries():
   if ("LABEL CSV" in purpose) or ("MERGE" in purpose): 
     loadLibrary("from datetime import timedelta")
     
+  if "COMBINE" in purpose: 
+    loadLibrary("import glob")
+    loadLibrary("import time")
+    loadLibrary("import pickle")
+    loadLibrary("import tempfile")
+    loadLibrary("import shutil")
+    loadLibrary("import multiprocessing")
+    loadLibrary("from concurrent.futures import ProcessPoolExecutor")
+
   if ("LABEL CSV" in purpose): 
     loadLibrary("import shutil")
+    loadLibrary("import multiprocessing")
+    loadLibrary("from concurrent.futures import ProcessPoolExecutor, as_completed")
+    loadLibrary("from scipy.signal import butter, sosfilt, sosfilt_zi","--user scipy")
 
   if "NEURAL" in purpose: 
 # Disable warning messages output from 'Tensorflow', eg if the computer running the code doesn't have any GPUs
@@ -481,14 +593,12 @@ def smoothActivities(predictedAct):
 # are the wrong way round, plots of the data will look incorrect - clumped together on the x-axis (datetime), rather than spread out evenly.                  |
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------
 def procSwitchMonthDay():
-  global df, smd, askUser
+  global df, smd, askUser, monthDaySwitched
   
 # If a value greater than '12' is detected, then we know which format we have, so don't need to switch here.
-  dfRand = df.sample(n = 20)
-  for index, row in dfRand.iterrows():
-    rowTime = row[0].strftime(dForm)
-    if (int(rowTime[5:7]) > 12) or (int(rowTime[8:10]) > 12):
-      return 
+  dfRand = df['Time'].sample(n = min(20,len(df)))
+  if (dfRand.dt.day > 12).any():
+    return 
 
 # Ask the user if they want to switch month/day - they may have tried running without switching, and found the plot looked incorrect. 
   if askUser:
@@ -501,35 +611,28 @@ def procSwitchMonthDay():
     if not smd:
       return    
 
-#---------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Switch the month/day values by converting the timestamp to a string, switching them in the string, then converting back to a timestamp.                            |
-# Somehow (it is not known how by the author) the conversion back to a timestamp can adjust the values passed in the string according to daylight saving differences |
-# (or possibly timezone). If this happens, adjust the timestamp by multiples of 30 minutes until it reflects the time in the string.                                 |
-#---------------------------------------------------------------------------------------------------------------------------------------------------------------------
-  smd = True      
-  dTime, newCol = "", []
+  smd, monthDaySwitched = True, True
   print("\nPlease wait, converting timestamps ...")
-  for index, row in df.iterrows():
-    row = row.values.tolist()
-    if dTime != row[0]:
-      dTime = row[0]
-      dTimex = str(dTime)
-      d2 = dTimex[0:5] + dTimex[8:10] + dTimex[4:7] + dTimex[10:] 
-      element = datetime.strptime(d2,dForm)
-      timestamp = datetime.timestamp(element)   
-      newstamp = pd.to_datetime(timestamp,unit='s')  
-      while str(newstamp) < d2:
-        newstamp = newstamp + pd.Timedelta(minutes=30)     
-      while str(newstamp) > d2:
-        newstamp = newstamp - pd.Timedelta(minutes=30)     
-    newCol.append(newstamp)
-  df['Time'] = newCol  
+  df['Time'] = switchMonthDayValues(df['Time'])
+
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Switch the month/day values for a whole column of timestamps at once. A new date is built from the year, with the day and month values swapped over, and the   |
+# time of day is added back on. Only the date parts change, so the clock time is kept exactly - there is no conversion through a timezone, and no daylight saving |
+# adjustment to undo.                                                                                                                                             |
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+def switchMonthDayValues(timeCol):
+  timeCol = pd.Series(timeCol)
+  dates = pd.DataFrame({'year': timeCol.dt.year, 'month': timeCol.dt.day, 'day': timeCol.dt.month})
+  return pd.to_datetime(dates) + (timeCol - timeCol.dt.normalize())
 
 #------------------------------------------------------------------------------------------------------------------
 # Get a list of column numbers from the user - to determine which columns are processed/passed to an output file. |  
 #------------------------------------------------------------------------------------------------------------------
 def getColumnNumbers():
   global colNums, numCols, df, includeCol, targetCol
+# When labelling a folder of recordings, the columns chosen for the first one are used for all of them
+  if reuseColumns:
+    return
   if numCols > 2:
     colNums = selectColumns(df.iloc[0],"Select the columns to process by column number (first column is column 0. CR for all columns). eg 2,3,4 or 2-4,6,7-9 - ",1)
 # Insert the Timestamp column if it wasn't specified - this must always be present
@@ -550,98 +653,275 @@ def getColumnNumbers():
 #---------------------------------------------------------------------------------------------------------------------------------------------------------------------
 # Timestamps read from an input file may be given down to 'second' level, but data is actually held at a 'minute' level (with the 'second' value always being '00'). |
 # For some of the data processing we need to know if we are looking for changes in the 'second' or 'minute' value from one data record to the next.                  |
-# If the datetime changes from one record to the next, but the 'second' value is '00' in both, then the data must be held at 'minute' level.                         | 
-# The flag 'perMinute' is set to indicate this.                                                                                                                      |
+# If every timestamp in the file has '00' for the 'second' then the data must be held at 'minute' level. The flag 'perMinute' is set to indicate this.               |
+# The number of records in each second/minute is then counted over the whole file. The first and last periods are usually only partly recorded, so are left out.   |
+# The frequency 'freq' is taken as the median count, so a single dropped or repeated packet doesn't affect it. The lowest and highest counts, the standard         |
+# deviation of the counts ('jitter') and any gaps (where one or more whole periods have no records) are held with it in the recording profile, 'recProfile'.         |
 #---------------------------------------------------------------------------------------------------------------------------------------------------------------------
-def checkPerMinuteSub(row):
-  global firstRec, fPeriod, nextRec, newPeriod, secondPart, breakVar, perMinute, checked
-  row = row.values.tolist()
-  rowTime = row[0]
-  if firstRec:
-    firstRec = False
-    fPeriod = rowTime
-  if rowTime != fPeriod:          
-    if nextRec:
-      newPeriod = rowTime
-      secondPart = str(rowTime)[-2:]
-      nextRec = False
-    else:
-      if newPeriod != rowTime:
-        checked = True
-        secondPart2 = str(rowTime)[-2:]
-        if secondPart == "00" and secondPart2 == "00":
-          breakVar, perMinute = True, True
-        else:  
-          breakVar, perMinute = True, False
-
-#------------------------------------------------------------------------
-# Check if data in an input file is held at 'second' or 'minute' level. |
-#------------------------------------------------------------------------
-def checkPerMinute(df):
-  global perMinute, dForm, breakVar, firstRec, nextRec, checked
-  if not "%S" in dForm:
-    return True 
-
-  firstRec, nextRec, breakVar, checked = True, True, False, False 
-  for index, row in df.iterrows():
-    checkPerMinuteSub(row)
-    if breakVar:
-      break
-
-  if not checked:
+def getRecordingProfile(timeCol):
+  times = timeCol.values.astype('datetime64[ns]').astype(np.int64)
+  secondNs = 1000000000
+  perMin = (not "%S" in dForm) or bool((times % (60*secondNs) == 0).all())
+  periodNs = 60*secondNs if perMin else secondNs
+
+# Find where the period changes from one record to the next, and the number of records in each period
+  periods = times // periodNs
+  starts = np.flatnonzero(np.diff(periods) != 0) + 1
+  if len(starts) < 2:
     print("\nInvalid file selected")
     print("Terminating")
     exit()
+  counts = np.diff(starts)
+
+  gapEnds = starts[np.diff(periods[np.r_[0, starts]]) > 1]
+  gaps = [[str(pd.Timestamp(times[i-1])), str(pd.Timestamp(times[i]))] for i in gapEnds]
+  return {'perMinute': perMin, 'freq': int(np.median(counts)), 'min': int(counts.min()), 'max': int(counts.max()),
+          'jitter': round(float(counts.std()),2), 'gaps': gaps}
+
+def showRecordingProfile():
+  period = "minute" if recProfile['perMinute'] else "second"
+  print("\nRecords per",period,"- median",recProfile['freq'],", min",recProfile['min'],", max",recProfile['max'],", jitter",recProfile['jitter'])
+  if recProfile['gaps']:
+    print("Gaps in recording -",len(recProfile['gaps']))
+    for gapStart, gapEnd in recProfile['gaps'][:10]:
+      print("  ",gapStart,"to",gapEnd)
+    if len(recProfile['gaps']) > 10:
+      print("   ...")
+
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Read a raw Axivity 'cwa' file directly, rather than a csv file exported from it by Open Movement (OM).                                                         |
+# A 'cwa' file consists of a header followed by 512 byte data sectors. Each data sector starts with 'AX' and holds a packed timestamp, the sampling rate, and    |
+# up to 120 accelerometer samples - either 'packed' (x, y and z held as 10 bit values plus a shared exponent in 4 bytes) or 'unpacked' (2 bytes per axis).      |
+# All sectors are decoded at once with numpy. The timestamp in a sector is for the sample at 'timestampOffset', so the time of each sample is interpolated      |
+# between the start times of consecutive sectors (using the nominal sampling rate where sectors are not consecutive).                                          |
+# The output has the same layout as an OM 'raw csv' export - a timestamp plus x, y and z values in units of gravity (g).                                        |
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+def readCwaFile(filename):
+  sectorType = np.dtype([('header','<u2'),('length','<u2'),('fractional','<u2'),('session','<u4'),('sequence','<u4'),('timestamp','<u4'),
+                         ('light','<u2'),('temperature','<u2'),('events','u1'),('battery','u1'),('rate','u1'),('axesBps','u1'),
+                         ('timestampOffset','<i2'),('sampleCount','<u2'),('data','u1',(480,)),('checksum','<u2')])
+  raw = np.memmap(filename, dtype=np.uint8, mode='r')
+  sectors = raw[:(len(raw)//512)*512].view(sectorType)
+
+# Keep the data sectors ('AX' with a payload of 508 bytes), and only those with the same sample format as the first one
+  sectors = sectors[(sectors['header'] == 0x5841) & (sectors['length'] == 508) & (sectors['sampleCount'] > 0)]
+  if len(sectors) == 0:
+    return pd.DataFrame(columns=["Time","Col 1","Col 2","Col 3"])
+  axesBps = sectors['axesBps'][0]
+  if (sectors['axesBps'] != axesBps).any():
+    print("Sectors with a different sample format have been ignored")
+    sectors = sectors[sectors['axesBps'] == axesBps]
+  numAxes, bytesPerSample = axesBps >> 4, axesBps & 0x0f
+
+# Sector timestamps are packed as (MSB) YYYYYYMM MMDDDDDh hhhhmmmm mmssssss, with an optional fraction of a second held in 'fractional'
+  ts = sectors['timestamp'].astype(np.int64)
+  sectorTime = pd.to_datetime(pd.DataFrame({'year': ((ts >> 26) & 0x3f) + 2000, 'month': (ts >> 22) & 0x0f, 'day': (ts >> 17) & 0x1f,
+                                             'hour': (ts >> 12) & 0x1f, 'minute': (ts >> 6) & 0x3f, 'second': ts & 0x3f}), errors='coerce')
+  validTime = sectorTime.notna().to_numpy()
+  sectors, sectorTime = sectors[validTime], sectorTime[validTime]
+  rate = 3200.0 / (1 << (15 - (sectors['rate'] & 0x0f)))
+
+# When the timestamp has a fraction (in units of 1/65536 s), the firmware reduces 'timestampOffset' by the number of whole samples in the fraction (so
+# readers that ignore the fraction still get about the right time) - add them back before using both
+  fractional = sectors['fractional'].astype(np.int64)
+  hasFraction = (fractional & 0x8000) != 0
+  timeFractional = np.where(hasFraction, (fractional & 0x7fff) << 1, 0)
+  timestampOffset = sectors['timestampOffset'].astype(np.int64) + np.where(hasFraction, (timeFractional * rate.astype(np.int64)) >> 16, 0)
+  sectorStart = sectorTime.to_numpy().astype('datetime64[ns]').astype(np.int64) + np.round((timeFractional / 65536.0 - timestampOffset / rate) * 1e9).astype(np.int64)
+
+# Decode the samples. Packed values are in units of 1/256 g; the units of unpacked values are held in the top bits of 'light' (1/256 g for the AX3).
+  if bytesPerSample == 0:
+    packed = np.ascontiguousarray(sectors['data']).view('<u4').astype(np.uint32)
+    shift = (6 - (packed >> 30)).astype(np.int16)
+    x = ((packed <<  6) & 0xffc0).astype(np.uint16).view(np.int16) >> shift
+    y = ((packed >>  4) & 0xffc0).astype(np.uint16).view(np.int16) >> shift
+    z = ((packed >> 14) & 0xffc0).astype(np.uint16).view(np.int16) >> shift
+    xyz = np.stack([x, y, z], axis=2) / 256.0
+  else:
+    unpacked = np.ascontiguousarray(sectors['data']).view('<i2')
+    unpacked = unpacked[:, :(unpacked.shape[1]//numAxes)*numAxes].reshape(len(sectors), -1, numAxes)
+    firstAccel = 3 if numAxes >= 6 else 0
+    accelUnit = (1 << (8 + ((sectors['light'].astype(np.int64) >> 13) & 0x07))).astype(float)
+    xyz = unpacked[:, :, firstAccel:firstAccel+3] / accelUnit[:, None, None]
+  count = np.minimum(sectors['sampleCount'].astype(np.int64), xyz.shape[1])
+
+# Interpolate sample times between consecutive sectors. Use the nominal rate after a break in the sequence, or if the interval looks wrong.
+  nominal = 1e9 / rate
+  interval = nominal.copy()
+  if len(sectors) > 1:
+    observed = np.diff(sectorStart) / count[:-1]
+    consecutive = (np.diff(sectors['sequence'].astype(np.int64)) == 1) & (observed > 0.5*nominal[:-1]) & (observed < 1.5*nominal[:-1])
+    interval[:-1] = np.where(consecutive, observed, nominal[:-1])
+
+  keep = np.arange(xyz.shape[1])[None, :] < count[:, None]
+  sampleIndex = np.broadcast_to(np.arange(xyz.shape[1]), keep.shape)[keep]
+  sectorIndex = np.repeat(np.arange(len(sectors)), keep.sum(axis=1))
+  sampleTime = sectorStart[sectorIndex] + np.round(sampleIndex * interval[sectorIndex]).astype(np.int64)
+  samples = xyz[keep]
+
+  return pd.DataFrame({"Time": pd.to_datetime(sampleTime), "Col 1": samples[:,0], "Col 2": samples[:,1], "Col 3": samples[:,2]})
+
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Read the first sheet of an Excel input file. For an xlsx file the rows are read as plain values, using python-calamine if it is available, or openpyxl in      |
+# 'read only' mode (which streams the rows from the file, without building an object for every cell). The first row holds the column headers. The dataframe is |
+# built a column at a time from the values. Old format 'xls' files are read with 'read_excel'.                                                                  |
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+def readExcelFile(filename):
+  if not filename.lower().endswith(".xlsx"):
+    return pd.read_excel(filename)
+  if CalamineWorkbook is not None:
+# calamine holds empty cells as empty strings
+    rows = ([None if value == "" else value for value in row] for row in CalamineWorkbook.from_path(filename).get_sheet_by_index(0).to_python())
+    workbook = None
+  else:  
+    workbook = load_workbook(filename, read_only=True, data_only=True)
+    rows = workbook.worksheets[0].iter_rows(values_only=True)
+  header = list(next(rows, []))
+  columns = [list(column) for column in itertools.zip_longest(*rows)]
+  if workbook is not None:
+    workbook.close()
+
+# Ignore empty columns at the end of the sheet
+  while columns and all(value is None for value in columns[-1]):
+    columns.pop()
+  header = (header + [None] * len(columns))[:len(columns)]
+  df = pd.DataFrame({ix: column for ix, column in enumerate(columns)})
+  df.columns = [f'Unnamed: {ix}' if name is None else name for ix, name in enumerate(header)]
+  return df
 
-  return perMinute
-
-#-----------------------------------------------------------------------------------------------
-# Find the per second/minute frequency within data by checking for a change in the time value. | 
-#-----------------------------------------------------------------------------------------------   
-def getFrequency():
-  global df, freq
-  fPeriod = df.iloc[0,0]
-  freq = 0
-  for index, row in df.iterrows():
-    rowTime = row[0]
-    if rowTime != fPeriod:       
-      if freq == 0:
-        newPeriod = rowTime
-      else:
-        if newPeriod != rowTime:
-          break
-      freq+=1
+#-----------------------------------------------------------------------------------------------------------------------------------------------------
+# Read an input file in chunks of 'chunkSize' records. A csv file is read a chunk at a time (decompressing it as it is read, if it is compressed); |
+# other file types are read whole and then split up.                                                                                              |
+#-----------------------------------------------------------------------------------------------------------------------------------------------------
+def readInputChunks(filename):
+  if cwaFile:
+    dfAll = readCwaFile(filename)
+  elif csvFile:
+    yield from pd.read_csv(filename, chunksize=chunkSize)
+    return
+  else:
+    dfAll = readExcelFile(filename)
+  for ix in range(0, len(dfAll), chunkSize):
+    yield dfAll.iloc[ix:ix+chunkSize]
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Find the format of the datetimes in the first column of an input file, as held in the file, by checking a sample of 20 records spread through the file        |
+# against the date and time formats that are catered for. Where the month and day are ambiguous the month is taken to come first, as when the format is not     |
+# specified. If no format matches every record in the sample an empty string is returned.                                                                       |
+#------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def detectDateTimeFormat(timeCol):
+  if pd.api.types.is_datetime64_any_dtype(timeCol):
+    return ""
+  sample = [str(t).strip() for t in timeCol.iloc[np.linspace(0, len(timeCol)-1, min(20,len(timeCol))).astype(int)]]
+  dateSeps = [*set(re.findall(r'[^a-zA-Z0-9\_ :.]', sample[0]))] + ["."]
+  dforms = ["%Y{0}%m{0}%d","%m{0}%d{0}%Y","%d{0}%m{0}%Y","%Y{0}%b{0}%d","%d{0}%b{0}%Y","%b{0}%d{0}%Y"]
+  tformats = ['%H:%M:%S.%f','%H:%M:%S','%H.%M.%S.%f','%H.%M.%S','%H:%M','%H.%M']
+  for dform in dforms:
+    for dateSep in dateSeps:
+      for tformat in tformats:
+        timeFormat = dform.format(dateSep) + " " + tformat
+        try:
+          for t in sample:
+            datetime.strptime(t, timeFormat)
+          return timeFormat
+        except ValueError:
+          pass
+  return ""
 
-#--------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Extract the data from a file into a csv/excel (Pandas) dataframe. Remove any rows with empty values.                                                                                |
-# Check the first part of each record in a random sample is a timestamp, and that there is at least one numeric value within each record (as a basic input file format verification). |
-# If a predictive model is being created ask the user for the column containing the 'category' (the label that the model is to be used to predict), and check the number of           |
-# categories in the column. There must be at least 2. If there are more than 10 ask the user if they have selected the correct column, otherwise display the categories.              |
-# Make sure the first column is in datetime format, then determine what the format is. If the datetime is at 'microsecond' level convert it to 'second' level.                        |
-# Check if records are actually held at 'minute' level but using a 'second' level timestamp (with '00' for the 'second').                                                             |
-# Check if month and day values may need to be switched.                                                                                                                              |
-# Ask the user which columns they wish to process - to be manipulated/included in an output file/model.                                                                               |
-# Find the per second/minute frequency of the data records.                                                                                                                           |
-# Ask the user if they wish to scale the data - the actual data values, or just for plotting (or neither).                                                                            |
-# If data is held at a 'second' rather than 'minute' level, ask the user how many records they wish to keep per second.                                                               |
-# Adjust the dataframe according to each response from the user.                                                                                                                      |
-#--------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-def getData(filename):
-  global df, perMinute, dForm, askCols, csvFile, freq, headers, headers2, dFormOrig, scalePlot, numCols, half, numericCols, tPeriod
-  global includeCol, combineFile, perSec, si, purpose, targetCol, uniqueLabel, dFrac, dfNoScale, twoOutputs
-  print("\nPlease wait, loading file ...") 
+#---------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Convert a column of datetimes held as text to timestamps in a single pass, using the format found by 'detectDateTimeFormat'. Records that don't match the     |
+# format (in a file with mixed formats) are converted individually. If no format was found every record is converted individually.                            |
+#---------------------------------------------------------------------------------------------------------------------------------------------------------------
+def parseTimestamps(timeCol,timeFormat):
+  if pd.api.types.is_datetime64_any_dtype(timeCol):
+    return timeCol
+  if timeFormat == "":
+    return parseMixedTimestamps(timeCol)
+  times = pd.to_datetime(timeCol, format=timeFormat, errors='coerce')
+  unmatched = times.isna()
+  if unmatched.any():
+    times[unmatched] = parseMixedTimestamps(timeCol[unmatched])
+  return times
+
+# Convert datetimes held as text that may be in more than one format. From pandas 2 'to_datetime' takes the format from the first value unless 'mixed' is
+# given, so each value is only converted on its own when 'mixed' is asked for (earlier versions always convert each value on its own).
+def parseMixedTimestamps(timeCol):
+  if int(pd.__version__.split('.')[0]) >= 2:
+    return pd.to_datetime(timeCol, format='mixed')
+  return pd.to_datetime(timeCol)
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Apply the processing chosen by the user for the first chunk of a large input file (in 'getData') to a later chunk - the datetime conversion, switching  |
+# month and day, the column selection, scaling and the proportion of records to keep (sampled with a seed for the chunk, 'chunkNumber').                    |
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------
+def processChunk(dfc,chunkNumber):
+  dfc = dfc.dropna(axis=0, how='any')
+  dfc.columns = ["Time"] + [f'Col {i}' for i in range(1,numColsIn)]
+  dfc['Time'] = parseTimestamps(dfc['Time'],timeFormat)
+  if roundTimes:
+    dfc['Time'] = dfc['Time'].dt.round('1s') 
+  if monthDaySwitched:
+    dfc['Time'] = switchMonthDayValues(dfc['Time'])
+
+  dfc = dfc.iloc[:,colNums].copy()
+  dfc.columns = ["Time"] + [f'Col {i}' for i in range(1,len(colNums))]
+  for i in numericCols:
+    dfc[dfc.columns[i]] = dfc[dfc.columns[i]].astype(float)
+
+  if dFrac != 1:
+    dfc = dfc.sample(frac=dFrac, random_state=sampleSeed + chunkNumber).sort_index()
+  if si == "D":
+    dfc = scaleData(dfc)
+  return dfc
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Generator providing the chunks of a large input file after the first one (which is held in 'df'), processed in the same way as the first chunk.         |
+# Purposes listed in 'streamPurposes' read the chunks from here one at a time. For other purposes 'getData' joins all the chunks together into 'df'.      |
+#------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getDataChunks(filename):
+  chunks = readInputChunks(filename)
+  next(chunks)
+  for chunkNumber, dfc in enumerate(chunks, 1):
+    dfc = processChunk(dfc,chunkNumber)
+    if len(dfc) > 0:
+      yield dfc
 
-# Get file contents
-  if csvFile:
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Load an input file into 'df' and carry out the checks that don't need any input from the user. Remove any rows with empty values.                          |
+# Check the first part of each record in a random sample is a timestamp, and that there is at least one numeric value within each record.                    |
+# Make sure the first column is in datetime format, then determine what the format is. If the datetime is at 'microsecond' level convert it to 'second' level.|
+# Check if records are actually held at 'minute' level but using a 'second' level timestamp (with '00' for the 'second'), and find the frequency.            |
+# The result is saved in the cache, and loaded from there the next time the same file is selected. Large files read in chunks are not cached.               |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+def loadInputFile(filename):
+  global df, dForm, roundTimes, perMinute, numColsIn, numericColsIn, streamInput, freq, timeFormat, recProfile, sampleSeed
+
+# Large csv files are read in chunks - the user's responses for the first chunk are applied to the rest of the file. The records kept from each chunk are
+# chosen with a seed set for the file, so reading the chunks again (eg for the two passes of a histogram) gives the same records.
+  fileSize = os.path.getsize(filename)
+  if compressedFile:
+    fileSize = fileSize * compressedSizeFactor
+  streamInput = csvFile and not cwaFile and fileSize > streamSizeLimit*1024*1024
+  if streamInput:
+    print("Reading the file in chunks of ",chunkSize," records")
+    sampleSeed = int(np.random.randint(2**31 - chunkSize))
+    df = next(readInputChunks(filename))
+  elif readCacheFile(filename):
+    showRecordingProfile()
+    return
+  elif cwaFile:
+    df = readCwaFile(filename)
+  elif csvFile:
     df = pd.read_csv(filename)   
   else:
-    df = pd.read_excel(filename)  
+    df = readExcelFile(filename)  
 
   df.dropna(axis=0, how='any', inplace=True)
 
   headers = [f'Col {i}' for i in range(1,len(df.iloc[0]))] 
   headers.insert(0,"Time")
   df.columns = headers
+  numColsIn = len(headers)
 
 # Perform basic data verification checks
   numSamp = min(5,len(df)) 
@@ -682,6 +962,123 @@ def getData(filename):
       print("Terminating")
       exit()
 
+# Make sure the first element is in datetime format. Find the format from a sample of records, then convert them all using it.
+  timeFormat = detectDateTimeFormat(df['Time'])
+  df['Time'] = parseTimestamps(df['Time'],timeFormat)
+
+# Convert microsecond timestamps to 'second'  
+  dForm = findDateTimeFormat(df.iloc[0,0])
+  roundTimes = ("%f" in dForm) or ("%f" in timeFormat)
+  if roundTimes:
+    df['Time'] = df['Time'].dt.round('1s') 
+    dForm = "%Y/%m/%d %H:%M:%S"
+
+# See if data is held at 'minute' level but with datetimes at 'second' level, and find the per second/minute frequency
+  recProfile = getRecordingProfile(df['Time'])
+  perMinute, freq = recProfile['perMinute'], recProfile['freq']
+  showRecordingProfile()
+
+# Find which columns contain numeric data  
+  numericColsIn = []
+  for i in range(1,numColsIn):
+    if (isInt(df.iloc[0][i]) or isFloat(df.iloc[0][i])):
+      df[df.columns[i]] = df[df.columns[i]].astype(float)
+      numericColsIn.append(i)
+
+  if not streamInput:
+    writeCacheFile(filename)
+
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Input files are cached in the folder 'cacheFolder', created in the same folder as the input file, in 'feather' format (if the pyarrow library is available),  |
+# which loads much faster than csv or xlsx files. The cached file is only used if the path, size, last modified time and a hash of the contents of the input  |
+# file are unchanged. The datetime format, recording profile ('minute' level flag, frequency etc) and numeric columns found for the file are saved with it.   |
+# When the cache folder holds more than 'cacheBudget' MB the least recently used files are deleted.                                                          |
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getCacheKey(filename):
+  fileStats = os.stat(filename)
+  contentHash = hashlib.sha1(str(fileStats.st_size).encode())
+  with open(filename, "rb") as f:
+    contentHash.update(f.read(1024*1024))
+    f.seek(max(0, fileStats.st_size - 1024*1024))
+    contentHash.update(f.read(1024*1024))
+  cacheFile = os.path.join(os.path.dirname(os.path.abspath(filename)), cacheFolder, hashlib.sha1(os.path.abspath(filename).encode()).hexdigest() + ".feather")
+  return cacheFile, {'path': os.path.abspath(filename), 'size': fileStats.st_size, 'mtime': fileStats.st_mtime, 'hash': contentHash.hexdigest()}
+
+def readCacheFile(filename):
+  global df, dForm, roundTimes, perMinute, numColsIn, numericColsIn, freq, recProfile
+  if feather is None:
+    return False
+  cacheFile, cacheKey = getCacheKey(filename)
+  if not os.path.isfile(cacheFile):
+    return False
+  try:
+    table = feather.read_table(cacheFile, memory_map=True)
+    cacheInfo = json.loads(table.schema.metadata[b'labelData'])
+  except Exception:
+    return False
+  if cacheInfo['key'] != cacheKey or not 'recProfile' in cacheInfo:
+    return False
+# Models need a category column as well as a datetime and a numeric value - let the checks on the file itself reject it if it doesn't have one 
+  if ("CREATE" in purpose.upper()) and len(table.column_names) < 3:
+    return False
+
+  print("Loading from cache - ",cacheFile)
+  df = table.to_pandas()
+  dForm, roundTimes, recProfile = cacheInfo['dForm'], cacheInfo['roundTimes'], cacheInfo['recProfile']
+  perMinute, freq = recProfile['perMinute'], recProfile['freq']
+  numColsIn, numericColsIn = len(df.columns), cacheInfo['numericCols']
+  os.utime(cacheFile)
+  return True
+
+def writeCacheFile(filename):
+  if feather is None:
+    return
+  cacheFile, cacheKey = getCacheKey(filename)
+  cacheInfo = {'key': cacheKey, 'dForm': dForm, 'roundTimes': roundTimes, 'recProfile': recProfile, 'numericCols': numericColsIn}
+  try:
+    os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'labelData': json.dumps(cacheInfo).encode()})
+    feather.write_feather(table, cacheFile, compression='uncompressed')
+  except Exception as e:
+    print("Unable to cache input file - ",e)
+    return
+
+  trimCacheFolder(os.path.dirname(cacheFile))
+
+# Remove the least recently used files (cached input files and plot pyramids) if the cache folder has grown too large
+def trimCacheFolder(folder):
+  cacheFiles = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith((".feather", ".npz"))]
+  cacheFiles = sorted(cacheFiles, key=os.path.getmtime)
+  cacheSize = sum(os.path.getsize(f) for f in cacheFiles)
+  while cacheSize > cacheBudget*1024*1024 and len(cacheFiles) > 1:
+    cacheSize -= os.path.getsize(cacheFiles[0])
+    os.remove(cacheFiles.pop(0))
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Extract the data from a file into a csv/excel (Pandas) dataframe. Remove any rows with empty values.                                                                                |
+# Check the first part of each record in a random sample is a timestamp, and that there is at least one numeric value within each record (as a basic input file format verification). |
+# If a predictive model is being created ask the user for the column containing the 'category' (the label that the model is to be used to predict), and check the number of           |
+# categories in the column. There must be at least 2. If there are more than 10 ask the user if they have selected the correct column, otherwise display the categories.              |
+# Make sure the first column is in datetime format, then determine what the format is. If the datetime is at 'microsecond' level convert it to 'second' level.                        |
+# Check if records are actually held at 'minute' level but using a 'second' level timestamp (with '00' for the 'second').                                                             |
+# Check if month and day values may need to be switched.                                                                                                                              |
+# Ask the user which columns they wish to process - to be manipulated/included in an output file/model.                                                                               |
+# Find the per second/minute frequency of the data records.                                                                                                                           |
+# Ask the user if they wish to scale the data - the actual data values, or just for plotting (or neither).                                                                            |
+# If data is held at a 'second' rather than 'minute' level, ask the user how many records they wish to keep per second.                                                               |
+# Adjust the dataframe according to each response from the user.                                                                                                                      |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getData(filename):
+  global df, perMinute, dForm, askCols, csvFile, freq, headers, headers2, dFormOrig, scalePlot, numCols, half, numericCols, tPeriod
+  global includeCol, combineFile, perSec, si, purpose, targetCol, uniqueLabel, dFrac, twoOutputs, cwaFile
+  global streamInput, numColsIn, roundTimes, monthDaySwitched, dfScaledPlot, numericColsIn
+  print("\nPlease wait, loading file ...") 
+
+# Get file contents, from the cache if the file has been loaded before
+  monthDaySwitched = False
+  loadInputFile(filename)
+
 # Get the category - value to be predicted - if creating a model
   numCols = len(df.iloc[0])
   includeCol = 0
@@ -703,21 +1100,6 @@ def getData(filename):
     uniqueLabel = list(df.iloc[:,targetCol].unique())
     includeCol = targetCol
 
-# Make sure the first element is in datetime format  
-  headers = [f'Col {i}' for i in range(1,numCols)] 
-  headers.insert(0,"Time")
-  df.columns = headers
-  df['Time'] = pd.to_datetime(df['Time'])
-
-# Convert microsecond timestamps to 'second'  
-  dForm = findDateTimeFormat(df.iloc[0,0])
-  if "%f" in dForm:
-    df['Time'] = df['Time'].dt.round('1s') 
-    dForm = "%Y/%m/%d %H:%M:%S"
-
-# See if data is held at 'minute' level but with datetimes at 'second' level
-  perMinute = checkPerMinute(df)
-
 # 'tperiod' is used for incrementing timestamps in some processing
   if "%S" in dForm:
     tPeriod = {'quantity': '1', 'time': 'seconds'}
@@ -743,33 +1125,35 @@ def getData(filename):
   dFormOrig = dForm
   startTime = setDatetimeFormat(df.iloc[0,0],dForm)
  
-# Find the per second/minute frequency
-  getFrequency() 
-  
-# Find which columns contain numeric data  
-  numericCols = []
-  for i in range(1,numCols):
-    if (isInt(df.iloc[0][i]) or isFloat(df.iloc[0][i])):
-      df[df.columns[i]] = df[df.columns[i]].astype(float)
-      numericCols.append(i)
+# Find which columns contain numeric data (the per second/minute frequency has been found when loading the file)
+  numericCols = [i for i in range(1,numCols) if colNums[i] in numericColsIn]
 
 # Ask if data should be scaled.
   scalePlot = scaleInputData() 
 
-# If data is held at a 'second' level, ask the user how many records to keep/process per second. If the user requested scaled and unscaled outputs, create subsets of the data for both.    
+# If data is held at a 'second' level, ask the user how many records to keep/process per second.
   if ("%S" in dForm) and not perMinute and freq > 5:
     if askUser:
       print("\nInput data has ",freq," readings per second")
       perSec = getPerSec(freq)
       dFrac = round(perSec/freq,2)
     df = df.sample(frac=dFrac).sort_index()
-    if twoOutputs:
-      dfNoScale = dfNoScale.sample(frac=dFrac).sort_index()
     freq = perSec
   else:  
     dFrac = 1
     
   half = int(freq/2)+1  
+
+# For a large file read in chunks, join the remaining chunks on to the first, unless the purpose processes them one at a time.
+  if streamInput and not any(sp in purpose for sp in streamPurposes):
+    print("\nPlease wait, loading the rest of the file ...")
+    dfChunks = [df]
+    for dfc in getDataChunks(filename):
+      dfChunks.append(dfc)
+    df = pd.concat(dfChunks)
+    if scalePlot:
+      dfScaledPlot = pd.DataFrame(scaler.transform(df[scaleColumns].to_numpy()))
+      dfScaledPlot.insert(0,"Time",df["Time"].to_numpy())
     
 #---------------------------------------------------------------------------------------------------------------------------------
 # Ask the user to select a folder. A separate Explorer window opens (in 'askdirectory') from which the user can select a folder. |
@@ -808,10 +1192,11 @@ def getYNInput(txt):
 #---------------------------------------------------------------------------------------------------------------------------------------------------------------------
 # Scale data so that large values for one variable don't have an undue influence on an algorithm, resulting in the values of other variables being under-represented |
 # in processing, or so that a plot does not have one or more variables separated from each other by large gaps, making it difficult to determine the changes in      |
-# one or more variables from the plot. Ask if the user wants both scaled and un-scaled outputs.                                                                      |
+# one or more variables from the plot. Ask if the user wants both scaled and un-scaled outputs - in which case the data is kept un-scaled, and the scaled output is   |
+# produced from it (with the fitted scaler) when the output files are written.                                                                                      |
 #---------------------------------------------------------------------------------------------------------------------------------------------------------------------   
 def scaleInputData():
-  global df, dfScaledPlot, scaleCols, scaleColumns, headers, scalePlot, numericCols, si, askUser, dfNoScale, purpose, twoOutputs
+  global df, dfScaledPlot, scaleCols, scaleColumns, headers, scalePlot, numericCols, si, askUser, purpose, twoOutputs, scaler
   twoOutputs = False
   if askUser:
     scalePlot, si = False, ""
@@ -821,9 +1206,17 @@ def scaleInputData():
     else:
       while si != "N" and si != "P" and si != "D":
         si = input("\nScale input data? No(N), For Plot Only(P), For Plot and Data(D)  - ").upper()
+        if si == "D" and streamInput and "COMBINE" in purpose.upper():
+          print("A file read in chunks can't be scaled when combining files - the scaling would only be found from its first chunk.")
+          si = ""
   if si == "N":  
     return scalePlot
 
+# The scaling is found from the data loaded, so a large file being combined (which is written a chunk at a time) can't be scaled. The file is left out
+# of the combined file ('combineFiles' and 'readCombineFile' catch the error), and the output file stays open for the rest of the files.
+  if si == "D" and streamInput and "COMBINE" in purpose.upper():
+    raise ValueError("the file is read in chunks, so it can't be scaled - the scaling would only be found from its first chunk")
+
   if si == "B":  
     twoOutputs = True
 
@@ -832,7 +1225,7 @@ def scaleInputData():
     done = True
     if len(numericCols) == 1:
       scaleCols = numericCols
-    else:  
+    elif not reuseColumns:  
       scaleCols = selectColumns(df.iloc[0],"Select the columns to scale by column number (first column is column 0. CR for all columns). eg 2,3,4 or 2-4,6,7-9 - ",1)
     for s in scaleCols:
       if s not in numericCols:
@@ -847,15 +1240,18 @@ def scaleInputData():
     scalePlot = True
     dfScaledPlot = pd.DataFrame(scaler.transform(df[scaleColumns].to_numpy()))
     dfScaledPlot.insert(0,"Time",df["Time"])
-  else:
-    if twoOutputs:  
-      dfNoScale = df.copy()  
-    df.loc[:, scaleColumns] = scaler.transform(df[scaleColumns].to_numpy())
-    for i in scaleCols:
-      df.iloc[:,i] = df.iloc[:,i].round(2)
+  elif not twoOutputs:
+    df = scaleData(df)
 
   return scalePlot
 
+# Scale the columns chosen by the user in a dataframe (in place), with the scaler fitted to the input file
+def scaleData(dfx):
+  dfx.loc[:, scaleColumns] = scaler.transform(dfx[scaleColumns].to_numpy())
+  for i in scaleCols:
+    dfx.iloc[:,i] = dfx.iloc[:,i].round(2)
+  return dfx
+
 #--------------------------------------------------------------------------------------------------------------------------------------
 # When a model is saved, the list of unique categories in the data file used to build the model are saved into a file called          |
 # 'activities.csv'. When this model is run to categorize unlabelled data the user is told which categories were contained in the      |
@@ -921,6 +1317,23 @@ def getPercent(txt,minP,maxP,defaultP):
       i = -1
   return i
 
+# Get one or more percentages from the user, separated by commas. Each one must be in the range 'minP' to 'maxP'. Repeated values are only used once.
+def getPercentList(txt,minP,maxP,defaultP):
+  while True:
+    i = input(txt)
+    if len(i.strip()) == 0:
+      return [defaultP]
+    percents = []
+    for p in i.split(","):
+      p = p.strip()
+      if not (isInt(p) or isFloat(p)) or float(p) < minP or float(p) > maxP:
+        percents = []
+        break
+      percents.append(float(p))
+    if len(percents) > 0:
+      return list(dict.fromkeys(percents))
+    print("Invalid entry. Each percentage must be in the range",minP,"to",maxP)
+
 #---------------------------------------------------------------------------------
 # Get an integer input value from the user, with min, max and default specified. |
 #---------------------------------------------------------------------------------
@@ -954,12 +1367,12 @@ def getStartStopTimes(trimTimes,tellText,startOnly):
   if trimTimes:
     if startOnly:
       while len(xp) != 1:
-        xp = plt.ginput(0,timeout=-1,mouse_add=1, mouse_pop=2, mouse_stop=3)
+        xp = getPlotClicks()
         if len(xp) != 1:
           print("\nYou must left click on one point only - the start time of the data of interest. Then right click.")
     else:
       while len(xp) != 2:
-        xp = plt.ginput(0,timeout=-1,mouse_add=1, mouse_pop=2, mouse_stop=3)
+        xp = getPlotClicks()
         if len(xp) != 2:
           print("\nYou must left click on two points - the start and end times of the data of interest. Then right click.")
   else:  
@@ -967,11 +1380,16 @@ def getStartStopTimes(trimTimes,tellText,startOnly):
 # be more (the user will have performed more than one label during the time period covered by the data file). If they've only
 # done two left clicks check with them that's what they meant to do.  
     while len(xp) < 2:
-      xp = plt.ginput(0,timeout=-1,mouse_add=1, mouse_pop=2, mouse_stop=3)
+      xp = getPlotClicks()
       if len(xp) == 2:
         if not getYNInput("\nAre you sure you've selected all the label transitions (Y/N) - "):
           xp = []
 
+# Get the clicks on the plot, leaving out any made with the toolbar's zoom or pan tool
+def getPlotClicks():
+  clicks = plt.ginput(0,timeout=-1,mouse_add=1, mouse_pop=2, mouse_stop=3)
+  return [click for click in clicks if click not in toolbarClicks]
+
 #----------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 # The magnify utility can be used on a plot when the user is selecting data. If it has been used y-values well above/below the other clicks entered should have been used,  |
 # so the magnifier clicks can be discarded. Ask the user for the y-values that determine magnifier clicks, and remove clicks above /below these values.                     |
@@ -1164,7 +1582,7 @@ def addLabelEntry(options):
 # Allow every 2nd time slice to be discarded automatically by labelling it as 'Other', without the user having to do this.                                     |                            |
 #---------------------------------------------------------------------------------------------------------------------------------------------------------------
 def getLabelsFromUser():
-  global pds, startTime, ivals, dForm, uniqueLabel, options, configFile, labelList, changed, configChange
+  global pds, startTime, segments, dForm, uniqueLabel, options, configFile, labelList, changed, configChange
 
   print(" ")
   options = setupList("Label")
@@ -1225,9 +1643,11 @@ def getLabelsFromUser():
     print("{}) {}".format(idx+1,element))
 
 # Get the user to associate a label with each time slice they selected from the plot. If they asked to automatically skip every 2nd one, assign 'Other' to these slices.  
-  ind = 0  
+# The time slices are held in the segment table 'segments' - the start and end times (as int64 nanoseconds) and a code for the label of each one, with the 
+# label for each code held in 'labels' (the same as 'uniqueLabel'). The times clicked on a plot are approximate, so records move on to the next time slice 
+# 'lag' records after the end time of the current one (see 'getRecordSegments').
   print("\nSelect label (by number) for each time period - \n")  
-  uniqueLabel = []
+  uniqueLabel, starts, ends, codes = [], [], [], []
   for px in pds:
     done = False
     if skipAlternate:
@@ -1242,40 +1662,179 @@ def getLabelsFromUser():
         if 0 < int(i) < (len(options)+1):
           done = True
           indx = len(startTime)+3
-          endTime = px[indx:]
-          ivals[ind][0] = datetime.strptime(endTime,dForm)
-          ivals[ind][1] = options[int(i)-1]
-          if not ivals[ind][1] in uniqueLabel:
-            uniqueLabel.append(ivals[ind][1])
-          ind += 1 
+          label = options[int(i)-1]
+          starts.append(pd.Timestamp(datetime.strptime(px[:indx-3],dForm)).value)
+          ends.append(pd.Timestamp(datetime.strptime(px[indx:],dForm)).value)
+          if not label in uniqueLabel:
+            uniqueLabel.append(label)
+          codes.append(uniqueLabel.index(label))
         else:  
           print("Invalid selection")        
       except:
         print("Invalid selection")
         pass
 
+  segments = {'start': np.array(starts, dtype=np.int64), 'end': np.array(ends, dtype=np.int64), 'code': np.array(codes, dtype=np.int64), 'labels': uniqueLabel,
+              'lag': half}
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Reduce the data to plot to at most 'maxPlotPoints' points per variable. The records are split into blocks of equal size, and the records holding the      |
+# minimum and maximum value of each variable in each block are kept (in time order), so the plot has the same outline as one of all the data. Returns the   |
+# timestamps and values to plot for each numeric variable (text columns, eg labels, are left out). The first column of 'dfx' holds the timestamps.          |
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------
+def decimateForPlot(dfx):
+  times = dfx.iloc[:,0].to_numpy()
+  dfValues = dfx.iloc[:,1:].select_dtypes('number')
+  columns = list(dfValues.columns)
+  values = dfValues.to_numpy(dtype=float)
+  n = len(times)
+  if n <= maxPlotPoints:
+    return {c: (times, values[:,i]) for i, c in enumerate(columns)}
+
+  blockSize = -(-n // (maxPlotPoints // 2))
+  rows = getPlotRows(getGroupExtremes(values, blockSize, np.argmin), getGroupExtremes(values, blockSize, np.argmax))
+  return {c: (times[rows[:,i]], values[rows[:,i], i]) for i, c in enumerate(columns)}
+
+# For each group of 'groupSize' consecutive rows of 'values' (the last group holds any rows left over), get the position of the row holding the minimum
+# ('argFunc' np.argmin) or maximum (np.argmax) value of each column
+def getGroupExtremes(values,groupSize,argFunc):
+  numFull = len(values) // groupSize
+  pos = argFunc(values[:numFull*groupSize].reshape(numFull, groupSize, -1), axis=1) + (np.arange(numFull) * groupSize)[:,None]
+  if numFull*groupSize < len(values):
+    pos = np.vstack([pos, argFunc(values[numFull*groupSize:], axis=0) + numFull*groupSize])
+  return pos
+
+# Put the rows holding the minimum and maximum of each block in time order, giving two rows per block for each column
+def getPlotRows(minRows,maxRows):
+  return np.stack([np.minimum(minRows, maxRows), np.maximum(minRows, maxRows)], axis=1).reshape(-1, minRows.shape[1])
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Build a min/max 'pyramid' of the data to plot, so the plot can be redrawn at the right level of detail whenever it's zoomed or panned. Level 0 holds the   |
+# rows with the minimum and maximum value of each variable in blocks of 'pyramidBase' records, and each level above combines 4 blocks of the level below,   |
+# until a level has no more than 'maxPlotPoints'/2 blocks. The pyramid is saved in the cache folder for the input file (as a numpy 'npz' file), keyed on    |
+# the input file's cache key, the variables plotted and a sample of the data, and loaded from there when the same data is plotted again.                   |
+# Only numeric variables are plotted - text columns, eg labels, are left out.                                                                              |
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getPlotPyramid(dfx):
+  columns = list(dfx.drop(columns='Time').select_dtypes('number').columns)
+  pyramid = {'times': dfx['Time'].to_numpy().astype('datetime64[ns]'), 'columns': columns, 'values': dfx[columns].to_numpy(dtype=float), 'levels': []}
+  values = pyramid['values']
+  if len(values) <= maxPlotPoints:
+    return pyramid
+
+  pyramidFile = getPyramidCacheFile(pyramid)
+  if pyramidFile != "" and os.path.isfile(pyramidFile):
+    try:
+      with np.load(pyramidFile) as cached:
+        pyramid['levels'] = [(int(blockSize), cached['min' + str(i)], cached['max' + str(i)]) for i, blockSize in enumerate(cached['blockSizes'])]
+      os.utime(pyramidFile)
+      return pyramid
+    except Exception:
+      pyramid['levels'] = []
+
+  rowType = np.int32 if len(values) < 2**31 else np.int64
+  blockSize, cols = pyramidBase, np.arange(len(columns))
+  minRows = getGroupExtremes(values, blockSize, np.argmin).astype(rowType)
+  maxRows = getGroupExtremes(values, blockSize, np.argmax).astype(rowType)
+  pyramid['levels'].append((blockSize, minRows, maxRows))
+  while len(minRows) > maxPlotPoints // 2:
+    blockSize *= 4
+    minRows = np.take_along_axis(minRows, getGroupExtremes(values[minRows, cols], 4, np.argmin), axis=0)
+    maxRows = np.take_along_axis(maxRows, getGroupExtremes(values[maxRows, cols], 4, np.argmax), axis=0)
+    pyramid['levels'].append((blockSize, minRows, maxRows))
+
+  if pyramidFile != "":
+    try:
+      levels = {}
+      for i, (blockSize, minRows, maxRows) in enumerate(pyramid['levels']):
+        levels.update({'min' + str(i): minRows, 'max' + str(i): maxRows})
+      np.savez(pyramidFile, blockSizes=np.array([level[0] for level in pyramid['levels']]), **levels)
+      trimCacheFolder(os.path.dirname(pyramidFile))
+    except Exception as e:
+      print("Unable to cache plot data - ",e)
+  return pyramid
+
+# Get the name of the cache file for a plot pyramid (or "" if the input file isn't known)
+def getPyramidCacheFile(pyramid):
+  inputFile = globals().get('filename', "")
+  if inputFile == "" or not os.path.isfile(inputFile):
+    return ""
+  cacheFile, cacheKey = getCacheKey(inputFile)
+  step = max(1, len(pyramid['times']) // 100000)
+  dataHash = hashlib.sha1(json.dumps([cacheKey, [str(c) for c in pyramid['columns']], len(pyramid['times'])]).encode())
+  dataHash.update(np.ascontiguousarray(pyramid['times'][::step]).tobytes())
+  dataHash.update(np.ascontiguousarray(pyramid['values'][::step]).tobytes())
+  os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+  return os.path.join(os.path.dirname(cacheFile), dataHash.hexdigest() + ".npz")
+
+# Get the rows to plot for each variable, for records 'first' to 'last' - all of them if there are few enough, otherwise the rows from the finest level of the
+# pyramid that gives no more than 'maxPlotPoints' points (blocks finer than level 0 are found from the records themselves)
+def getVisibleRows(pyramid,first,last):
+  numCols = len(pyramid['columns'])
+  if last - first <= maxPlotPoints:
+    return np.broadcast_to(np.arange(first, last)[:,None], (last - first, numCols))
+  blockSize = -(-(last - first) // (maxPlotPoints // 2))
+  if blockSize <= pyramidBase or len(pyramid['levels']) == 0:
+    values = pyramid['values'][first:last]
+    return getPlotRows(getGroupExtremes(values, blockSize, np.argmin), getGroupExtremes(values, blockSize, np.argmax)) + first
+  for levelBlockSize, minRows, maxRows in pyramid['levels']:
+    if levelBlockSize >= blockSize:
+      break
+  return getPlotRows(minRows[first // levelBlockSize:(last - 1) // levelBlockSize + 1], maxRows[first // levelBlockSize:(last - 1) // levelBlockSize + 1])
+
+# Redraw the plot for the range of time now shown (called when the plot is zoomed or panned). The x-axis holds days since 1970-01-01.
+def redrawPlot(ax):
+  times = plotPyramid['times']
+  x0, x1 = ax.get_xlim()
+  first = max(int(np.searchsorted(times, np.datetime64(int(x0 * 86400 * 1e9), 'ns'))) - 1, 0)
+  last = min(int(np.searchsorted(times, np.datetime64(int(x1 * 86400 * 1e9), 'ns'), side='right')) + 1, len(times))
+  if last <= first:
+    return
+  rows = getVisibleRows(plotPyramid, first, last)
+  for i, line in enumerate(plotPyramid['lines']):
+    line.set_data(times[rows[:,i]], plotPyramid['values'][rows[:,i], i])
+  ax.figure.canvas.draw_idle()
+
+# Note clicks made on the plot while the toolbar zoom or pan tool is selected, so they aren't taken as time slice selections
+def noteToolbarClick(event):
+  toolbar = event.canvas.manager.toolbar if event.canvas.manager is not None else None
+  if toolbar is not None and toolbar.mode != "" and event.inaxes:
+    toolbarClicks.append((event.xdata, event.ydata))
+
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------  
 # Display a plot of the data, and get time slices/start and end times/a starttime from the plot by the user left clicking on it, depending on the function |
 # the code is being run for. Apply scaling to the displayed data if requested.                                                                             |
 #   The user left clicks the start time, then left clicks the end time, then right clicks.                                                                 |  
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------  
 def plotData(df,sTime,eTime,trimTimes,startOnly,tellText):
-  global startTime, stopTime, dForm, plt_y_min, plt_y_max, scalePlot, dfScaledPlot, xp, dfNoScale, twoOutputs
+  global startTime, stopTime, dForm, plt_y_min, plt_y_max, scalePlot, dfScaledPlot, xp, twoOutputs, plotPyramid, toolbarClicks
   
   plt.rcParams["figure.figsize"] = [14.50, 6.50]
   plt.rcParams["figure.autolayout"] = True
   
   print("\nPlease wait, plotting data ...")
+# If both scaled and un-scaled outputs are wanted the data is held un-scaled, so plot a scaled copy of it (discarded after plotting)
   if scalePlot:
     dfToPlot = dfScaledPlot
+  elif twoOutputs:
+    dfToPlot = scaleData(df.copy())
   else:
     dfToPlot = df
 
-# Plot all data, or a time slice of it, depending on function.    
-  if sTime == 0:
-    dfToPlot.set_index('Time').plot()
-  else:
-    dfToPlot.loc[(dfToPlot['Time'] >= sTime) & (dfToPlot['Time'] <= eTime)].set_index('Time').plot()
+# Plot all data, or a time slice of it, depending on function. Large data is reduced to the outline of its values, from a pyramid that gives more detail
+# when the plot is zoomed or panned (the plot is redrawn whenever the range of the x-axis changes).
+  if sTime != 0:
+    dfToPlot = dfToPlot.loc[(dfToPlot['Time'] >= sTime) & (dfToPlot['Time'] <= eTime)]
+  plotPyramid = getPlotPyramid(dfToPlot)
+  times = plotPyramid['times']
+  rows = getVisibleRows(plotPyramid, 0, len(times))
+  fig, ax = plt.subplots()
+  plotPyramid['lines'] = [ax.plot(times[rows[:,i]], plotPyramid['values'][rows[:,i], i], label=col)[0] for i, col in enumerate(plotPyramid['columns'])]
+  ax.legend()
+  ax.callbacks.connect('xlim_changed', redrawPlot)
+  toolbarClicks = []
+  fig.canvas.mpl_connect('button_press_event', noteToolbarClick)
+  toolbar = fig.canvas.manager.toolbar if fig.canvas.manager is not None else None
 
 # Display datetimes vertically on the x-axis (otherwise they take up too much room)      
   plt.xticks(rotation=90)
@@ -1289,11 +1848,12 @@ def plotData(df,sTime,eTime,trimTimes,startOnly,tellText):
 # Get left clicks from the user, defining time periods
   getStartStopTimes(trimTimes,tellText,startOnly)     
   plt.close()
+  plotPyramid = None
   
 # If the user used the magnifier tool on the plot there will be clicks (used to select areas of the plot to magnify) that were not for time slice selection.
-# The user should have clicked on y-values well above/below the values clicked when selecting time slices, when they used the magnifier. We'll discard 
-# clicks with y-values above/below values specified by the user.
-  if len(xp) > 2:
+# Clicks made with the toolbar's zoom or pan tool have already been removed. Without a toolbar, the user should have clicked on y-values well above/below 
+# the values clicked when selecting time slices, when they used the magnifier. We'll discard clicks with y-values above/below values specified by the user.
+  if len(xp) > 2 and toolbar is None:
     if getYNInput("\nWas the magnifier tool used (Y/N) - "):
       procMagnifierClicks()
             
@@ -1308,12 +1868,8 @@ def plotData(df,sTime,eTime,trimTimes,startOnly,tellText):
 # Set the dataframe to contain just the records within the time slice selected by the user from the plot.  
   if startOnly:
     df = df.loc[(df['Time'] >= sTime1)]
-    if twoOutputs:
-      dfNoScale = dfNoScale.loc[(dfNoScale['Time'] >= sTime1)]
   else:
     df = df.loc[(df['Time'] >= sTime1) & (df['Time'] < eTime1)]
-    if twoOutputs:
-      dfNoScale = dfNoScale.loc[(dfNoScale['Time'] >= sTime1) & (dfNoScale['Time'] < eTime1)]
   
 # If the user was selecting the start/stop times of the data of interest that's now been done, so return.
   if trimTimes:
@@ -1328,6 +1884,8 @@ def plotData(df,sTime,eTime,trimTimes,startOnly,tellText):
 # Plot data produced by the function selected by the user. Some plots provide a separate scale on the right hand y-axis to give a more appropriate display than using       |
 # one scale on one y-axis provides. For example, if unlabelled data has been labelled, the label values will be integers starting from '1', but the data may be eg integers |
 # in the region of 40 or above (for a heartrate). The label values will be much clearer when plotted with a second scale.                                                   | 
+# Large data is reduced to the outline of its values (see 'decimateForPlot'). Labels (in the last column) are shown as coloured bands behind the data, one band for each    |
+# run of records with the same label, with a legend showing the colour of each label.                                                                                       |
 #----------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 def plotData2(df,twoYLabels):
   global numericCols
@@ -1346,18 +1904,26 @@ def plotData2(df,twoYLabels):
   plt.rcParams["figure.autolayout"] = True
   plt.rcParams['axes.prop_cycle'] = matplotlib.cycler(color=colorMix)
 
-  df.set_index('Time')
-  
-  ax.plot(df.iloc[:,0],df.iloc[:,numericCols[1:]])
+  for i, (times, values) in enumerate(decimateForPlot(df.iloc[:,[0] + numericCols[1:]]).values()):
+    ax.plot(times, values, color=colorMix[i % len(colorMix)])
   ax.set_xlabel("Time", fontsize = 10)
   ax.set_ylabel("Value",fontsize = 10,color="blue")
   
-# Create a 2nd y-axis if required  
+# Show the labels as bands if required - all the bands for one label are drawn together, spanning the height of the plot
   if twoYLabels:
-    ax2=ax.twinx()
-    ax2._get_lines.prop_cycler = ax._get_lines.prop_cycler
-    ax2.plot(df.iloc[:,0],df.iloc[:,-1])
-    ax2.set_ylabel("Label",fontsize=10)
+    times = matplotlib.dates.date2num(df.iloc[:,0].to_numpy())
+    labels = df.iloc[:,-1].to_numpy()
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    ends = np.r_[times[starts[1:]], times[-1]]
+    handles = []
+# Fix the y-axis limits to those of the data first - the bands are drawn in axes units on the y-axis, but would still be included in its autoscaling
+    ax.set_ylim(ax.get_ylim())
+    for i, label in enumerate(pd.unique(labels[starts])):
+      bands = starts[labels[starts] == label]
+      ranges = list(zip(times[bands], ends[np.searchsorted(starts, bands)] - times[bands]))
+      ax.broken_barh(ranges, (0, 1), transform=ax.get_xaxis_transform(), facecolors=colorMix[i % len(colorMix)], alpha=0.25, zorder=0)
+      handles.append(matplotlib.patches.Patch(color=colorMix[i % len(colorMix)], alpha=0.25, label=str(label)))
+    ax.legend(handles=handles, title="Label", fontsize=8)
   
   plt.xticks(rotation=90)
   plt.minorticks_on()
@@ -1946,7 +2512,7 @@ def produceLabelledFile(xfilename,getAssoc,aList,uniqueLabel,activities,txt):
   response = "C"
   while response == "C":
     predictedFile, fName = getNewFilename("",folder,"Enter output filename")
-    response = checkFileExists(predictedFile,True,False)
+    response = checkFileExists(predictedFile,csvFile,False)
   response = "C"
  
   if getAssoc:    
@@ -1974,7 +2540,7 @@ def produceLabelledFile(xfilename,getAssoc,aList,uniqueLabel,activities,txt):
   column_names = headers     
 
 # Produce an output file    
-  writeOutputFile(df,True,predictedFile,True)
+  writeOutputFile(df,predictedFile,True)
 
 #--------------------------------------------------------------------------------------------------------------------------
 # Determine the format of the input datetime field (input files must have a datetime as the first element in each record) |
@@ -2327,193 +2893,241 @@ def runSavedKeras(xfilename):
 # Create an output file containing the original data, plus predicted labels.  
   produceLabelledFile(xfilename,True,aList,uniqueLabel,activities,"NN01Jul2022")
   
-#---------------------------------------------------------------------------------------------------------------------------------------------------------
-# Append the label associated with the timestamp of the current record (held in 'ivals[ind][1]') to the record, then add it to 'outRecs'                 |
-# (which will be written to the output file). If the label has changed from the record for the previous label, store the transition point, which is used |
-# when building the summary file to determine the mean and standard deviation of numeric variables for each time period associated with a single label.  |
-#---------------------------------------------------------------------------------------------------------------------------------------------------------
-def createRecord(ind):
-  global row, activities, newTime, firstAct, transVal, transition, numCols, getRms, outRecs
-  outRec = [newTime]
-  for i in range(1,numCols):
-    outRec.append(row[i])
-  if getRms:  
-    outRec.append(round(svm,2))
-  outRec.append(ivals[ind][1])
-  activities.append(ivals[ind][1])  
-  transVal+=1
-  if firstAct:
-    firstAct = False
-  else:
-    if activities[-1] != activities[-2]:
-      transition.append(transVal)    
-  outRecs.append(outRec)
-
 #----------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# When labelling unlabelled data, ask the user if they wish to add a root mean squared value to the output file, and, if so, which input columns to generate it from. |
+# When labelling unlabelled data, ask the user if they wish to add derived values to the output file - a root mean squared value and/or the accelerometry values in   |
+# 'featureCodes' - and, if so, which input columns to generate them from. The values are added to the data before it is plotted, so they appear on the plot too.     |
 #----------------------------------------------------------------------------------------------------------------------------------------------------------------------
-def procRms():
-  global getRms, rmsCols, headers2, df, numericCols
-  getRms = False
-  rmsCols = []  
+def procFeatures():
+  global features, featureCols, df, numericCols
+  features, featureCols = [], []
   if len(numericCols) > 1:
-    ok = False
-    if getYNInput("\nCreate Root Mean Square values? (Y/N) : "):
-      getRms = True
+    if getYNInput("\nCreate Root Mean Square or accelerometry (ENMO, HFEN, angle-z) values? (Y/N) : "):
       done = False
       while not done:
         done = True
+        featureCols = []
         if len(numericCols) > 2:
-          rmsCols = selectColumns(df.iloc[0],"Select the columns to include in RMS value (first column is column 0). eg 2,3,4 or 2-4,6,7-9 (CR for all numeric columns) - ",2)
-        if len(rmsCols) == 0:
-          rmsCols = numericCols
-        else:  
-          for r in rmsCols:
-            if not r in numericCols:
-              print("You can only select numeric values for inclusion.")
-              done = False
+          featureCols = selectColumns(df.iloc[0],"Select the columns to create the values from - the x,y,z columns in that order for ENMO, HFEN and angle-z (first column is column 0). eg 2,3,4 or 2-4,6,7-9 (CR for all numeric columns) - ",2)
+        if len(featureCols) == 0:
+          featureCols = numericCols
+        for r in featureCols:
+          if not r in numericCols:
+            print("You can only select numeric values for inclusion.")
+            done = False
+        if not done:
+          continue
+        codes = input("Select the values to create - root mean square (R), ENMO (E), HFEN (H), angle-z (A). eg R,E,A (CR for R) - ").upper().replace(" ","")
+        codes = codes.split(",") if codes != "" else ["R"]
+        if any(c not in featureCodes for c in codes):
+          print("Select from R, E, H and A.")
+          done = False
+        elif len(featureCols) != 3 and any(c != "R" for c in codes):
+          print("ENMO, HFEN and angle-z need exactly three columns (x,y,z).")
+          done = False
+        elif "H" in codes and perMinute:
+          print("HFEN can only be created for readings held at a 'second' level.")
+          done = False
+        elif "H" in codes and dFrac != 1:
+          print("HFEN needs every reading - it can't be created when only some readings per second are kept.")
+          done = False
+        elif si == "D" and any(c != "R" for c in codes) and any(c in scaleCols for c in featureCols):
+          print("ENMO, HFEN and angle-z need un-scaled x,y,z values - they can't be created from columns scaled for the data (D).")
+          done = False
+      features = [featureCodes[c] for c in featureCodes if c in codes]
+  addFeatures()
+
+# Append the derived values chosen by the user to the data (and to the scaled data used for plotting), and to the output file headers
+def addFeatures():
+  global df, dfScaledPlot, headers2
+  if len(features) == 0:
+    return
+  print("\nCreating ",", ".join(features)," values ...")
+  values = getFeatureValues(df)
+  for i, feature in enumerate(features):
+    df[feature] = values[:,i]
+    if scalePlot:
+      dfScaledPlot[feature] = values[:,i]
+  headers2[-1:-1] = features
+
+#---------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Calculate the derived values in 'features' (or in 'featureList') for every record at once, from the columns in 'featureCols'. Each value is based on the      |
+# Euclidean norm (the square root of the sum of the squares) of the selected columns :                                                                          |
+#  rms    - the norm itself                                                                                                                                     |
+#  enmo   - the norm minus one (g), with negative values set to zero                                                                                            |
+#  hfen   - the norm of the columns after a high-pass filter (cutoff 'hfenCutoff' Hz) at the data's frequency, removing gravity and slow changes in orientation |
+#           (starting from the filter's steady state for the first reading, so there is no start-up spike at the beginning of the file)                         |
+#  anglez - the angle (degrees) between the z axis and the horizontal plane                                                                                     |
+# enmo, hfen and anglez are only created from un-scaled values (see 'procFeatures'), and hfen only when every reading is kept.                                  |
+#---------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getFeatureValues(dfx,featureList=None):
+  values = dfx.iloc[:, featureCols].to_numpy(dtype=float)
+  norm = np.sqrt(np.einsum('ij,ij->i', values, values))
+  result = []
+  for feature in (features if featureList is None else featureList):
+    if feature == "rms":
+      result.append(norm.round(2))
+    elif feature == "enmo":
+      result.append(np.maximum(norm - 1, 0).round(3))
+    elif feature == "hfen":
+      sos = butter(4, hfenCutoff, btype='highpass', fs=freq, output='sos')
+      filtered = sosfilt(sos, values, axis=0, zi=sosfilt_zi(sos)[:,:,np.newaxis]*values[0])[0]
+      result.append(np.sqrt(np.einsum('ij,ij->i', filtered, filtered)).round(3))
+    elif feature == "anglez":
+      result.append(np.degrees(np.arctan2(values[:,2], np.hypot(values[:,0], values[:,1]))).round(2))
+  return np.column_stack(result)
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Get the count, mean, sum of squared differences from the mean ('m2'), minimum and maximum of each column of 'values' for each segment, in one grouped pass. |
+# 'segIds' holds the segment number (0 to numSegs-1) of each row. Segments with no rows have a count of zero.                                               |
+#------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getSegmentStats(values,segIds,numSegs):
+  grouped = pd.DataFrame(values).groupby(segIds).agg(['count','mean','var','min','max'])
+  segs = grouped.index.values
+  stats = {}
+  for stat, fill in (('count',0.0),('mean',0.0),('var',0.0),('min',np.inf),('max',-np.inf)):
+    stats[stat] = np.full((numSegs, values.shape[1]), fill)
+    stats[stat][segs] = grouped.xs(stat, axis=1, level=1).values
+  stats['m2'] = np.nan_to_num(stats.pop('var') * (stats['count'] - 1))
+  return stats
+
+# Combine the statistics for two sets of rows (eg consecutive chunks of a file) - the means and 'm2' values are merged using Chan's parallel form of Welford's method
+def mergeSegmentStats(stats1,stats2):
+  count = stats1['count'] + stats2['count']
+  delta = stats2['mean'] - stats1['mean']
+  with np.errstate(invalid='ignore', divide='ignore'):
+    weight = np.where(count > 0, stats2['count'] / count, 0.0)
+  return {'count': count,
+          'mean': stats1['mean'] + delta * weight,
+          'm2': stats1['m2'] + stats2['m2'] + delta**2 * stats1['count'] * weight,
+          'min': np.minimum(stats1['min'], stats2['min']),
+          'max': np.maximum(stats1['max'], stats2['max'])}
 
-  if getRms:
-   headers2.insert(-1, 'rms')
-   
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------------   
 # After labelling an input file, write a summary showing the mean and standard deviation for each numeric item in the output records, over each time slice          |
 # specified by the user. Do this chronologically, and then by label, if there is more than one time slice for a single label (so that means/stds for different time |
 # slices can be easily compared visually).                                                                                                                          |
+# The time slice of each output record ('rowSegments') is taken from the segment table. Each run of records from time slices with the same label is a segment of     |
+# the summary. The statistics for all segments and columns are found together, 'chunkSize' records at a time, and the results for each chunk are merged, so large   |
+# output files don't need a second copy in memory.                                                                                                                  |
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------------
-def writeSummaryFile(df,transition,includeSubjectId,summary,sfilename,uniqueLabel):
+def writeSummaryFile(df,includeSubjectId,summary,sfilename):
   global subjectId, location
+  if len(df) == 0:
+    return
 # Get the columns containing numeric items
-  numCols = len(df.iloc[0])
-  numericCols = []
-  for i in range(1,numCols):
-    if (isInt(df.iloc[0][i]) or isFloat(df.iloc[0][i])):
-      numericCols.append(i)
-  
-# Use 'groupby' on the label to get the mean and standard deviation, for each time slice, for each label.
-# 'includeSubjectId' is True if the user wants subjectId and sensor location included.
-# Use 'thisLabel' to indicate if there is more than one time slice for the same label.
-  ixx = 0
-  labList = []
-  prevLabel = ""
-  byLabel = False
-  
-  for ix in range(1,len(transition)): 
-    duration = df.iloc[transition[ix]][0] - df.iloc[ixx][0]
-    if includeSubjectId:
-      summaryLine = subjectId + ", " + df.iloc[ixx][numCols-1] + ", " + location + ", " + str(duration) + ", " 
-    else:
-      summaryLine = df.iloc[ixx][numCols-1] + ", " + str(duration) + ", " 
-    
-    for i in range(1,numCols-1):   
-      if i in numericCols:
-        result = df.iloc[ixx:(transition[ix]-1)].groupby('label')[headers[i]].mean().values
-        summaryLine = summaryLine + str(result)[1:-1] + ", "
-        result = df.iloc[ixx:(transition[ix]-1)].groupby('label')[headers[i]].std().values
-        summaryLine = summaryLine + str(result)[1:-1] + ", "
-    summaryLine = summaryLine.rstrip(" ")    
-    summaryLine = summaryLine.rstrip(",")    
-    summary.append(summaryLine.split(","))
-    thisLabel = df.iloc[ixx,-1]
-    if (thisLabel in labList) and (thisLabel != prevLabel):
-      byLabel = True
-    else:    
-      labList.append(thisLabel)  
-    prevLabel = thisLabel      
-    ixx = transition[ix]  
+  numericCols = [i for i in range(1,len(df.columns)-1) if isInt(df.iloc[0,i]) or isFloat(df.iloc[0,i])]
+  values = df.iloc[:,numericCols].to_numpy(dtype=float)
+
+# Number the segments - a new segment starts wherever the label code changes
+  codes = segments['code'][rowSegments]
+  labels = np.array(segments['labels'], dtype=object)[codes]
+  newSegment = np.r_[True, codes[1:] != codes[:-1]]
+  segIds = np.cumsum(newSegment) - 1
+  starts = np.flatnonzero(newSegment)
+  numSegs = len(starts)
+
+  stats = None
+  for first in range(0, len(df), chunkSize):
+    chunkStats = getSegmentStats(values[first:first+chunkSize], segIds[first:first+chunkSize], numSegs)
+    stats = chunkStats if stats is None else mergeSegmentStats(stats, chunkStats)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    stds = np.sqrt(stats['m2'] / (stats['count'] - 1))
+  stds[stats['count'] < 2] = np.nan
+
+# A segment lasts from its first record to the first record of the next segment (or the last record, for the final segment)
+  times = df['Time'].values
+  durations = pd.to_timedelta(np.r_[times[starts[1:]], times[-1]] - times[starts])
+
+# One summary record per segment, optionally including the subject id and sensor location
+  summaryRecs = pd.DataFrame({'Label': labels[starts], 'Duration': [str(d) for d in durations]})
+  if includeSubjectId:
+    summaryRecs.insert(0, 'Subject', subjectId)
+    summaryRecs.insert(2, 'Location', location)
+  for i in range(len(numericCols)):
+    summaryRecs['Mean' + str(i+1)] = stats['mean'][:,i].round(8)
+    summaryRecs['Std' + str(i+1)] = stds[:,i].round(8)
+    if summaryMinMax:
+      summaryRecs['Min' + str(i+1)] = stats['min'][:,i]
+      summaryRecs['Max' + str(i+1)] = stats['max'][:,i]
 
 # Write the summary records by time period into the summary file.  
-  outRecs = []
-  for s in summary:
-    outRecs.append(s)
-  df2 = pd.DataFrame(outRecs)
-  writeOutputFile(df2,True,sfilename,True)
+  writeOutputFile(pd.DataFrame([summary[0]]),sfilename,True)
+  writeOutputFile(summaryRecs,sfilename,False)
 
 # Write a space line to the summary file, then sort the records by label type and write them again to summary, if there is at least one label for which there is
 # more than one time slice.
-  if byLabel:
-    outRecs = [" "]
-    df2 = pd.DataFrame(outRecs)
-    writeOutputFile(df2,True,sfilename,False)
-    outRecs = []
-    del summary[0]  
-    if includeSubjectId:
-      summary = sorted(summary, key=lambda x: x[1])
-    else:
-      summary = sorted(summary, key=lambda x: x[0])
-    for s in summary:
-      s = ', '.join(s)
-      outRecs.append(s)
-    df2 = pd.DataFrame(outRecs)
-    writeOutputFile(df2,True,sfilename,False)
+  if summaryRecs['Label'].duplicated().any():
+    writeOutputFile(pd.DataFrame([" "]),sfilename,False)
+    writeOutputFile(summaryRecs.sort_values('Label', kind='stable'),sfilename,False)
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Find the time slice in the segment table 'segments' that each record belongs to (given the record timestamps as int64 nanoseconds). A record belongs to     |
+# the first time slice that ends after it. If the table has a 'lag' (for time slices selected from a plot), a record only moves on to the next time slice    |
+# once 'lag' records have passed the end time of the current one - the next time slice starts at the 'lag'th record after the end time, or the 'lag'th      |
+# record after the start of the current time slice if that is later.                                                                                        |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getRecordSegments(times):
+  numSlices = len(segments['end'])
+  if segments['lag'] == 0:
+    return np.minimum(np.searchsorted(segments['end'], times, side='right'), numSlices-1)
+
+  firstAfterEnd = np.searchsorted(times, segments['end'], side='right')
+  nextSlice, ix = [], -1
+  for iy in range(numSlices-1):
+    ix = max(ix+1, firstAfterEnd[iy]) + segments['lag'] - 1
+    if ix >= len(times):
+      break
+    nextSlice.append(ix)
+  return np.searchsorted(np.array(nextSlice, dtype=np.int64), np.arange(len(times)), side='right')
 
 def writeLabelledFile(df,xfilename):
-  global row, activities, newTime, firstAct, transVal, transition, numCols, getRms, outRecs, summary
+  global numCols, features, summary, rowSegments
   
   summary = []
-  summaryList = summaryHead
+  summaryList = list(summaryHead)
+  statNames = ["Mean","Std","Min","Max"] if summaryMinMax else ["Mean","Std"]
 # Create a header line for the summary file
   for i in range(len(numericCols)):
-    summaryList+=["Mean" + str((i+1))] + ["Std" + str((i+1))]
-  if getRms:  
-    summaryList+=["Rms Mean"] + ["Rms Std"]
+    summaryList+=[stat + str((i+1)) for stat in statNames]
+  for feature in features:
+    summaryList+=[feature.capitalize() + " " + stat for stat in statNames]
   summary.append(summaryList)
   
-# For each record in the subset of records from the input file chosen by the user :
-#  Set the timestamp - for every time slice after the first one, the timestamp of each record will be amended. The timestamp of the first record in a time slice
-#  is set to the timestamp of the last record of the previous time slice (except for the first time slice) plus one second or one minute, depending on whether the 
-#  input file's timestamps are at second or minute level. All subsequent timestamps in the time slice increment from this first value.
-#  Append a root mean square value, if requested.
-#  Append the label chosen by the user for the time slice (held in 'ivals').
+# For the subset of records from the input file chosen by the user (all columns are processed at once) :
+#  Find the time slice each record belongs to, from the segment table (see 'getRecordSegments').
 #  Skip any records with a label of 'Other'.
-# Make a note of the locations in the dataframe where transitions occur from one label to the next, for creating the summary file.
-# All records for the output file are stored in outRecs.
-  firstAct, replaceTime = True, False
-  outRecs, activities, transition, transVal, iy, ix = [], [], [0], 0, 0, 0
-  for index, row in df.iterrows():  
-    if replaceTime:
-      saveTime = iTime  
-    iTime = row[0] 
-    if ivals[iy][1] == "Other":
-      if not replaceTime:
-        newTime = iTime
-        replaceTime = True
-      writeRow = False
-    else:
-      writeRow = True
-      if replaceTime:
-        if(iTime != saveTime):
-          newTime = newTime + timedelta(**tPeriod)
-      else:
-        newTime = iTime
-    if getRms:
-      svm = 0    
-      for i in range(1,numCols): 
-        if i in rmsCols:
-          svm+=float(row[i])**2
-      svm=svm**0.5
-    if (iTime <= ivals[iy][0]): 
-      if writeRow:  
-        createRecord(iy)      
-    else:
-      ix+=1
-      if ix < half:
-        if writeRow: 
-          createRecord(iy)          
-      else: 
-        ix=0
-        if ivals[(iy+1)][1] != "Other":
-          createRecord(iy+1)
-        iy+=1
-#        if not isDatetime(str(ivals[iy][0])):
-#          break        
-
-  transition.append(-1)  
+#  Set the timestamp - once the first 'Other' record is reached, the timestamps of the records that follow are amended. The timestamp of the first record after 
+#  an 'Other' time slice is set to the timestamp of the last record written before it plus one second or one minute, depending on whether the input file's 
+#  timestamps are at second or minute level. All subsequent timestamps increment from this value, by one second/minute each time the input timestamp changes.
+#  Keep the derived values (eg root mean square), if requested.
+#  Append the label chosen by the user for the time slice.
+  times = df['Time'].values.astype('datetime64[ns]').astype(np.int64)
+  sliceLabels = np.array(segments['labels'], dtype=object)[segments['code']]
+  slices = getRecordSegments(times)
+  labels = sliceLabels[slices]
+  writeRow = labels != "Other"
+
+# The timestamp of the record where a new time slice starts depends on whether the previous time slice was 'Other'
+  prevSlices = slices.copy()
+  newSlice = np.flatnonzero(slices[1:] != slices[:-1]) + 1
+  prevSlices[newSlice] = slices[newSlice-1]
+  otherRow = sliceLabels[prevSlices] == "Other"
+  newTimes = times.copy()
+  if otherRow.any():
+    firstOther = np.argmax(otherRow)
+    timeChange = ~otherRow[firstOther+1:] & (times[firstOther+1:] != times[firstOther:-1])
+    newTimes[firstOther] = times[firstOther]
+    newTimes[firstOther+1:] = times[firstOther] + pd.Timedelta(**tPeriod).value * np.cumsum(timeChange)
+
+  dfOut = df.iloc[writeRow, :numCols+len(features)].reset_index(drop=True)
+  dfOut['Time'] = pd.to_datetime(newTimes[writeRow])
+  dfOut['label'] = labels[writeRow]
+  dfOut.columns = headers2
+  rowSegments = slices[writeRow]
 
 # Write the output file  
-  df = pd.DataFrame(outRecs,columns=headers2)
-  writeOutputFile(df,True,xfilename,True)
-  return df
+  writeOutputFile(dfOut,xfilename,True)
+  return dfOut
   
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------
 # Append a label to each record in a subset of records from an input file selected by the user. Write two output files - one with the data, and a summary. |
@@ -2525,24 +3139,43 @@ def writeLabelledFile(df,xfilename):
 # grouped by label type.                                                                                                                                   |
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------
 def labelFile(filename):
-  global options, ivals, numCols, startTime, stopTime, summary, row, svm, freq, dForm, df, newTime, activities, headers, numericCols
-  global writer, total, transVal, transition, firstAct, uniqueLabel, dFormOrig, getRms, rmsCols, headers2, si, dfScaled, colNums
-  global perMinute, outRecs, csvFile, firstIsCsv, subjectId, location, dfNoScale, summaryHead, twoOutputs
+  global options, segments, numCols, startTime, stopTime, summary, freq, dForm, df, activities, headers, numericCols
+  global writer, total, uniqueLabel, dFormOrig, features, featureCols, headers2, si, dfScaled, colNums
+  global perMinute, csvFile, firstIsCsv, subjectId, location, summaryHead, twoOutputs
 
   firstIsCsv = csvFile  
 
-# Ask the user if they wish to include a root mean square value in the output file, and if so, which columns to base it on.
-  procRms()
-    
-  ivals = [[0] * 2 for i in range(100)]
+# Ask the user if they wish to include a root mean square value (or other derived values) in the output file, and if so, which columns to base it on.
+  procFeatures()
+
+# Time slices can be selected from a plot, or read from an annotations file (for this input file, or for each recording in the input file's folder).
+  labelSource = ""
+  while labelSource != "P" and labelSource != "A" and labelSource != "F":
+    labelSource = input("\nSelect time periods from a plot (P), read them from an annotations file (A), or label every recording in the folder from its annotations file (F) - ").upper()
+  if labelSource == "F":
+    labelFolder(filename)
+    return
+
+  if labelSource == "A":
+    annFile = getAnnotationsFile(filename)
+    if annFile == "":
+      print("\nSelect annotations file")
+      root = Tk(); root.withdraw()
+      annFile = fd.askopenfilename(filetypes=[("Annotations file", "*.csv .json")])
+      root.destroy()
+    print("\nAnnotations file - ",annFile)
+    if not applyAnnotations(annFile):
+      return
+  else:
 
 # Create a list of labels for the user to choose from
-  options = setupList("Label") 
-  print("\nDisplaying data file for label selection ...")
-  print("Note - if the magnifier is used click y-values well above/below clicks used for label selection.")
+    options = setupList("Label") 
+    print("\nDisplaying data file for label selection ...")
+    print("Note - the plot's zoom and pan tools show more detail, and clicks made with them are ignored. If the plot has no toolbar and the magnifier is used,")
+    print("click y-values well above/below clicks used for label selection.")
 
 # The user selects time slices from a plot of the data, and specifies the label to be appended for each time slice  
-  df = plotData(df,0,0,False,False,'Select timestamps of transitions between activities using mouse left-click. Finish inputs with mouse right-click. Remove entry with delete/backspace.')
+    df = plotData(df,0,0,False,False,'Select timestamps of transitions between activities using mouse left-click. Finish inputs with mouse right-click. Remove entry with delete/backspace.')
 
 # Ask if a subjectid (eg name) and sensor location should be included in the summary file
   if getYNInput("\nInclude SubjectId and sensor location in the summary file? (Y/N) - "):
@@ -2574,30 +3207,10 @@ def labelFile(filename):
     response = checkFileExists(sfilename,False,False)
 
   print("\nPlease wait, processing data ...")
-# Initialse stats variables
-  rStd, total = 0, 0
-
-# 'tPeriod' defines the time period to add to a timestamp when transitioning from one time slice to the next
-  if "%S" in dFormOrig:
-    tPeriod = {'quantity': '1', 'time': 'seconds'}
-  else:
-    tPeriod = {'quantity': '1', 'time': 'minutes'}
-  tPeriod = {tPeriod['time']: int(tPeriod['quantity'])}  
-
-# If the user wants both scaled and unscaled output files, produce both (if the user only requested one output, this will already be held in 'df').
-  if twoOutputs:
-    fn0, fn1 = os.path.splitext(os.path.abspath(xfilename))
-    xfilenameNS = fn0 + "NoScale" + fn1
-    fn0, fn1 = os.path.splitext(os.path.abspath(sfilename))
-    sfilenameNS = fn0[:-4] + "NoScale_sum" + fn1
-    dfNoScale = writeLabelledFile(dfNoScale,xfilenameNS)
-    writeSummaryFile(dfNoScale,transition,includeSubjectId,summary,sfilenameNS,uniqueLabel)
-
-  df = writeLabelledFile(df,xfilename)
-  writeSummaryFile(df,transition,includeSubjectId,summary,sfilename,uniqueLabel)
+  writeLabelOutputs(xfilename,sfilename,includeSubjectId)
 
 # Display a plot of the output file with the specified activities if the user wishes.
-  if getYNInput("\nPlot labelled data (Y/N) : "): 
+  if labelSource == "P" and getYNInput("\nPlot labelled data (Y/N) : "): 
     ind = 1
     for ac in uniqueLabel:
       if ac.upper() != "OTHER":
@@ -2618,34 +3231,242 @@ def labelFile(filename):
     
     plotData2(df,True)
 
+#----------------------------------------------------------------------------------------------------------------------------------------------------------
+# Write the labelled output file and its summary file, for the time slices held in 'segments'. If the user wants both scaled and unscaled output files,  |
+# the data is held un-scaled - the records are labelled once and written to the 'NoScale' files, then the same records are scaled and written to the     |
+# main output files. The root mean square value is recalculated from the scaled values; enmo, hfen and anglez keep their un-scaled values.               |
+#----------------------------------------------------------------------------------------------------------------------------------------------------------
+def writeLabelOutputs(xfilename,sfilename,includeSubjectId):
+  global df
+  if not twoOutputs:
+    df = writeLabelledFile(df,xfilename)
+    writeSummaryFile(df,includeSubjectId,summary,sfilename)
+    closeOutputFiles()
+    return
+
+  fn0, fn1 = splitOutputFilename(os.path.abspath(xfilename))
+  xfilenameNS = fn0 + "NoScale" + fn1
+  fn0, fn1 = splitOutputFilename(os.path.abspath(sfilename))
+  sfilenameNS = fn0[:-4] + "NoScale_sum" + fn1
+  df = writeLabelledFile(df,xfilenameNS)
+  writeSummaryFile(df,includeSubjectId,summary,sfilenameNS)
+
+  df = scaleData(df)
+  if "rms" in features:
+    df["rms"] = getFeatureValues(df,["rms"])[:,0]
+  writeOutputFile(df,xfilename,True)
+  writeSummaryFile(df,includeSubjectId,summary,sfilename)
+  closeOutputFiles()
+
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Read the time slices for an input file from an annotations file, rather than from a plot. The annotations file is a csv file with 'start', 'end' and 'label'  |
+# columns, or a json file holding a list of records with 'start', 'end' and 'label' values. The time slices are put in time order, and any gaps between them are |
+# labelled 'Other' (so are left out of the output file). The input data is reduced to the records from the start of the first time slice to the end of the last |
+# one, as when the start and end are selected from a plot.                                                                                                      |
+# Each record is given the label of the time slice it falls in - the table's 'lag' is 0, so a short time slice may hold no records and later labels don't shift.|
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------
+def readAnnotationsFile(annFile):
+  if annFile.lower().endswith(".json"):
+    with open(annFile) as f:
+      annotations = json.load(f)
+    if isinstance(annotations, dict):
+      annotations = annotations.get('annotations', [])
+    annotations = pd.DataFrame(annotations)
+  else:
+    annotations = pd.read_csv(annFile, skipinitialspace=True)
+  annotations.columns = [str(col).strip().lower() for col in annotations.columns]
+  if not all(col in annotations.columns for col in ('start', 'end', 'label')):
+    print("\nInvalid annotations file - ",annFile," - it must have 'start', 'end' and 'label' values")
+    return None
+
+  annotations = annotations.dropna(subset=['start', 'end', 'label'])
+  annotations['start'] = parseTimestamps(annotations['start'],detectDateTimeFormat(annotations['start']))
+  annotations['end'] = parseTimestamps(annotations['end'],detectDateTimeFormat(annotations['end']))
+  annotations = annotations.dropna(subset=['start', 'end']).sort_values('start', kind='stable')
+
+# Build the segment table, adding an 'Other' time slice for each gap between annotations. If annotations overlap, the overlapping time is given to the earlier one.
+  labels, starts, ends, codes = [], [], [], []
+  for start, end, label in zip(annotations['start'], annotations['end'], annotations['label']):
+    label = "Other" if str(label).strip().upper() == "OTHER" else str(label).strip()
+    start, end = start.value, end.value
+    if ends and start > ends[-1]:
+      if not "Other" in labels:
+        labels.append("Other")
+      starts.append(ends[-1]); ends.append(start); codes.append(labels.index("Other"))
+    if ends and end <= ends[-1]:
+      continue
+    if not label in labels:
+      labels.append(label)
+    starts.append(max(start, ends[-1]) if ends else start); ends.append(end); codes.append(labels.index(label))
+
+  if not ends:
+    print("\nNo time periods found in annotations file - ",annFile)
+    return None
+  return {'start': np.array(starts, dtype=np.int64), 'end': np.array(ends, dtype=np.int64), 'code': np.array(codes, dtype=np.int64), 'labels': labels,
+          'lag': 0}
+
+def applyAnnotations(annFile):
+  global segments, uniqueLabel, df
+  segments = readAnnotationsFile(annFile)
+  if segments is None:
+    return False
+
+  sTime, eTime = pd.Timestamp(segments['start'][0]), pd.Timestamp(segments['end'][-1])
+  df = df.loc[(df['Time'] >= sTime) & (df['Time'] < eTime)]
+  if len(df) == 0:
+    print("\nNo input records fall within the time periods in the annotations file.")
+    return False
+  uniqueLabel = segments['labels']
+  return True
+
+# Get the name of a recording, without its folder or file type (or compression type)
+def getRecordingName(filename):
+  name = os.path.basename(filename)
+  for ext in (".gz", ".zst", ".bz2", ".xz"):
+    if name.lower().endswith(ext):
+      name = name[:-len(ext)]
+  return os.path.splitext(name)[0]
+
+# Find the annotations file for a recording - '<recording name>_annotations.csv' or '.json' in the same folder. Return "" if there isn't one.
+def getAnnotationsFile(filename):
+  for ext in (".csv", ".json"):
+    annFile = os.path.join(os.path.dirname(filename), getRecordingName(filename) + "_annotations" + ext)
+    if os.path.isfile(annFile):
+      return annFile
+  return ""
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Label every recording in the input file's folder that has an annotations file, using a pool of 'labelWorkers' processes. The responses given for the input file  |
+# (columns to process, scaling, proportion of records to keep, root mean square values) are used for every recording. Output files are written to the folder       |
+# chosen by the user, called '<recording name>_labelled' and '<recording name>_labelled_sum'. If a subjectid is included in the summary files, the recording name  |
+# is used as the subjectid.                                                                                                                                        |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def labelFolder(filename):
+  global location, summaryHead, csvOutputOptions
+  inputFolder = os.path.dirname(os.path.abspath(filename))
+  recordings = []
+  for f in sorted(os.listdir(inputFolder)):
+    recording = os.path.join(inputFolder, f)
+    if f.lower().endswith((".csv", ".csv.gz", ".csv.zst", ".csv.bz2", ".csv.xz", ".zip", ".xls", ".xlsx", ".cwa")) and getAnnotationsFile(recording) != "":
+      recordings.append(recording)
+  if len(recordings) == 0:
+    print("\nNo recordings with an annotations file ('<recording name>_annotations.csv' or '.json') found in - ",inputFolder)
+    return
+  print("\n",len(recordings)," recordings with annotations files found in - ",inputFolder)
+
+  includeSubjectId = getYNInput("\nInclude SubjectId (the recording name) and sensor location in the summary files? (Y/N) - ")
+  if includeSubjectId: 
+    print("\nSelect sensor location : ")
+    location = letUserPick(setupList("Location")) 
+    summaryHead = ["Subject","Label","Location","Duration"]
+  else:  
+    summaryHead = ["Label","Duration"]
+
+  folder = selectFolder(inputFolder,"\nSelect the folder to create the output files in (D) for - " + inputFolder + " or select folder (S) (D/S) - ")
+  if firstIsCsv:
+    if csvOutputOptions is None:
+      csvOutputOptions = getCsvOutputOptions()
+    extension = getOutputExtension()
+  else:
+    extension = ".xlsx"
+
+# Check if any of the output files already exist
+  outFiles = []
+  for recording in recordings:
+    fName = os.path.join(folder, getRecordingName(recording) + "_labelled")
+    outFiles += [fName + extension, fName + "_sum" + extension]
+    if twoOutputs:
+      outFiles += [fName + "NoScale" + extension, fName + "NoScale_sum" + extension]
+  outFiles = [f for f in outFiles if os.path.isfile(f)]
+  if len(outFiles) > 0:
+    response = ""
+    while response != "O" and response != "S":
+      response = input("\n" + str(len(outFiles)) + " of the output files already exist. Overwrite them (O) or stop (S) : ").upper()
+    if response == "S":
+      print("\nTerminating ...")
+      exit()
+    for f in outFiles:
+      os.remove(f)
+
+  settings = {name: globals().get(name) for name in ('purpose', 'smd', 'si', 'scalePlot', 'dFrac', 'perSec', 'colNums', 'scaleCols', 'features', 'featureCols',
+                                                      'firstIsCsv', 'csvOutputOptions', 'summaryHead', 'location')}
+  settings.update({'askUser': False, 'reuseColumns': True})
+
+  print("\nPlease wait, labelling recordings ...")
+  with ProcessPoolExecutor(max_workers=labelWorkers, mp_context=multiprocessing.get_context("spawn")) as executor:
+    futures = [executor.submit(labelRecording, recording, folder, extension, includeSubjectId, settings) for recording in recordings]
+    for future in as_completed(futures):
+      recording, result = future.result()
+      print(os.path.basename(recording)," - ",result)
+
+# Label one recording from its annotations file, in a worker process started by 'labelFolder'. Output from the processing is held back, and the last message
+# from it is returned if the recording could not be labelled.
+def labelRecording(recording,folder,extension,includeSubjectId,settings):
+  global subjectId
+  globals().update(settings)
+  output = io.StringIO()
+  try:
+    with contextlib.redirect_stdout(output):
+      loadLibraries()
+      setInputFileType(recording)
+      getData(recording)
+      addFeatures()
+      if applyAnnotations(getAnnotationsFile(recording)):
+        subjectId = getRecordingName(recording)
+        fName = os.path.join(folder, subjectId + "_labelled")
+        writeLabelOutputs(fName + extension, fName + "_sum" + extension, includeSubjectId)
+        return recording, str(len(df)) + " records labelled"
+  except SystemExit:
+    pass
+  except Exception as e:
+    closeOutputFiles()
+    return recording, "not labelled - " + str(e)
+  closeOutputFiles()
+  return recording, "not labelled - " + getLastMessage(output)
+
+# Get the last message in the output held back by a worker process (leaving out blank lines and 'Terminating'), to report why a file wasn't processed
+def getLastMessage(output):
+  lastLines = [line.strip() for line in output.getvalue().splitlines() if line.strip() != "" and line.strip() != "Terminating"]
+  return lastLines[-1] if lastLines else "no output"
+
 #--------------------------------------------------------------------------------------------------------------------
 # Get the user to select the data file being processed. A separate file explorer window pops up from which they can |
 # click on the file, then on 'open'. Note if the file is 'csv'. Put the file contents (or a subset) in a dataframe. |
 #--------------------------------------------------------------------------------------------------------------------
 def getInputFile(purpose,inText):
-  global csvFile
   filename = ""
   while filename == "":
     print(inText)   
     root = Tk(); root.withdraw()
-    filename = fd.askopenfilename(filetypes=[("Input file", "*.csv .xls .xlsx")])
+    filename = fd.askopenfilename(filetypes=[("Input file", "*.csv .csv.gz .csv.zst .csv.bz2 .csv.xz .zip .xls .xlsx .cwa")])
     root.destroy()
     print("\nFile selected - ",filename)    
-    _ , inputFileType = os.path.splitext(filename)
-    if inputFileType == ".csv":
-      csvFile = True
-    else:  
-      csvFile = False
+    setInputFileType(filename)
     getData(filename)
   return filename
 
+#----------------------------------------------------------------------------------------------------------------------------------------------------
+# Note the type of an input file. Output files are of the same type as the (first) input file - csv for a raw 'cwa' file or a compressed csv file.  |
+# Compressed csv files (.csv.gz, .csv.zst, .csv.bz2, .csv.xz, or a .zip holding a single csv file) are decompressed by pandas as they are read.     |
+#----------------------------------------------------------------------------------------------------------------------------------------------------
+def setInputFileType(filename):
+  global csvFile, cwaFile, compressedFile
+  fileName , inputFileType = os.path.splitext(filename.lower())
+  compressedFile = inputFileType in (".gz", ".zst", ".bz2", ".xz", ".zip")
+  if compressedFile and inputFileType != ".zip":
+    _ , inputFileType = os.path.splitext(fileName)
+  cwaFile = inputFileType == ".cwa"
+  csvFile = inputFileType in (".csv", ".cwa", ".zip")
+
 #-----------------------------------
 # Get a new filename from the user |
 #-----------------------------------
 def getNewFilename(defaultFname,folder,txt):
-  global csvFile   
+  global csvFile, csvOutputOptions
   if csvFile:
-    extension = ".csv"
+    if csvOutputOptions is None:
+      csvOutputOptions = getCsvOutputOptions()
+    extension = getOutputExtension()
   else:  
     extension = ".xlsx"
 
@@ -2673,6 +3494,49 @@ def getNewFilename(defaultFname,folder,txt):
     
   return(newFile, fName)
 
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+# Ask the user how csv output files should be written - the number of decimal places for numeric values, and whether to compress them. This is asked |
+# once for each purpose, the first time an output filename is needed.                                                                               |
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+def getCsvOutputOptions():
+  decimals = None
+  while True:
+    places = input("\nNumber of decimal places for numeric values in csv output files (CR for full precision) : ")
+    if places == "":
+      break
+    if isInt(places) and int(places) >= 0:
+      decimals = int(places)
+      break
+    print("Invalid entry. Must be an integer >= 0")
+
+  compression = ""
+  while True:
+    if zstandard is None:
+      response = input("Compress csv output files with gzip (G) or no compression (N) (CR for N) : ").upper()
+    else:  
+      response = input("Compress csv output files with gzip (G), zstandard (Z) or no compression (N) (CR for N) : ").upper()
+    if response == "G":
+      compression = "gzip"
+    elif response == "Z" and zstandard is not None:
+      compression = "zstd"
+    elif response != "N" and response != "":
+      continue
+    break
+
+  return {'decimals': decimals, 'compression': compression}
+
+# The file type of csv output files, including the compression type chosen by the user
+def getOutputExtension():
+  return ".csv" + {"gzip": ".gz", "zstd": ".zst", "": ""}[csvOutputOptions['compression']]
+
+# Split an output filename into its name and extension, keeping the '.gz'/'.zst' of a compressed csv file with the '.csv'
+def splitOutputFilename(newFile):
+  fn0, fn1 = os.path.splitext(newFile)
+  if fn1 in (".gz", ".zst"):
+    fn0, fn2 = os.path.splitext(fn0)
+    fn1 = fn2 + fn1
+  return fn0, fn1
+
 #--------------------------------------------------------------------------------------------------------
 # Show the user an input record, then get them to select a single column, which may need to be numeric. |
 #--------------------------------------------------------------------------------------------------------
@@ -2704,17 +3568,20 @@ def selectSingleColumn(txt,numericReqd):
 #------------------------------------------------------------------------------------------------------------------------------------------------------
 # When pre-processing physiological data, ask the user whether blocks of data are processed per minute, or per number of records - the mean value     |
 # of blocks of data is calculated on this basis, for determining whether or not to amend data values (we know we are dealing with an input file       |
-# with timestamps at a minute, rather than second, level.                                                                                             |                                                                             |
+# with timestamps at a minute, rather than second, level). Or the data can be changed at change points found in it, rather than by block.             |
 #------------------------------------------------------------------------------------------------------------------------------------------------------
 def getMinuteBlockResponse():
   print(" ")
-  byMinute, byBlock, perBlock = False, False, 0
+  byMinute, byBlock, perBlock, byChangePoint = False, False, 0, False
   while True:
-    txt = "Process data on a minute by minute basis (M) or by blocks containing a specified number of records (B) : "    
+    txt = "Process data on a minute by minute basis (M), by blocks containing a specified number of records (B) or by finding change points (C) : "    
     response = input(txt).upper()  
     if response == "M":
       byMinute = True
       break
+    if response == "C":
+      byChangePoint = True
+      break
     if response == "B":
       byBlock = True
       while True:    
@@ -2725,22 +3592,25 @@ def getMinuteBlockResponse():
         except ValueError:
           print("Invalid entry. Must be an integer > 1 and <= ",freq)
       break
-  return byMinute, byBlock, perBlock
+  return byMinute, byBlock, perBlock, byChangePoint
 
 #--------------------------------------------------------------------------------------------------------------------------------------------------------
 # When pre-processing physiological data, ask the user whether blocks of data are processed per minute, per number of seconds, or per number of records | 
-# - the mean value of blocks of data is calculated on this basis, for determining whether or not to amend data values.                                  |                                                                                          |                                                                             |
+# - the mean value of blocks of data is calculated on this basis, for determining whether or not to amend data values - or by change points.            |                                                                                          |                                                                             |
 #--------------------------------------------------------------------------------------------------------------------------------------------------------
 def getSecondsBlockResponse():
   print(" ")
   perBlock, secondsPerBlock = 0, 0
-  byMinute, bySeconds, byBlock = False, False, False
+  byMinute, bySeconds, byBlock, byChangePoint = False, False, False, False
   while True:
-    txt = "Process data on a minute by minute basis (M), by blocks of seconds (S) or by blocks containing a specified number of records (B) : "    
+    txt = "Process data on a minute by minute basis (M), by blocks of seconds (S), by blocks containing a specified number of records (B) or by finding change points (C) : "    
     response = input(txt).upper()  
     if response == "M":
       byMinute = True
       break
+    if response == "C":
+      byChangePoint = True
+      break
     if response == "B":
       byBlock = True
       while True:    
@@ -2762,13 +3632,14 @@ def getSecondsBlockResponse():
           print("Invalid entry. Must be an integer > 1 and <= ",freq)
       break
       
-  return byMinute, bySeconds, byBlock, perBlock, secondsPerBlock
+  return byMinute, bySeconds, byBlock, perBlock, secondsPerBlock, byChangePoint
 
 
 #---------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Amend the values in one numeric column of the input file if, on a block of data basis, the mean value for one block differs from the mean value for the period     |
-# of one block from two blocks earlier, by more than a specified percentage. If this is the case set the values for the previous block to the same as the values for |
-# the current block. Blocks are defined per minute, per number of seconds, or per number of records, as specified by the user.                                       |                                                                                                        |
+# Amend the values in one or more numeric columns of the input file if, on a block of data basis, the mean value for one block differs from the mean value for the    |
+# period of one block from two blocks earlier, by more than a specified percentage. If this is the case set the values for the previous block to the same as the      |
+# values for the current block. Blocks are defined per minute, per number of seconds, or per number of records, as specified by the user.                            |
+# Several percentages can be given, to compare the results. An output file is written for each one, or a single output file with the percentage in the last column.  |
 #---------------------------------------------------------------------------------------------------------------------------------------------------------------------
 def preProcessPhysiological(filename): 
   global colNums, df, numericCols, csvFile, firstIsCsv, freq, perMinute
@@ -2780,10 +3651,10 @@ def preProcessPhysiological(filename):
   print("Records per minute - ",freq)
 
   if perMinute:
-    bySeconds = False
-    byMinute, byBlock, perBlock = getMinuteBlockResponse()
+    bySeconds, secondsPerBlock = False, 0
+    byMinute, byBlock, perBlock, byChangePoint = getMinuteBlockResponse()
   else:  
-    byMinute, bySeconds, byBlock, perBlock, secondsPerBlock = getSecondsBlockResponse()
+    byMinute, bySeconds, byBlock, perBlock, secondsPerBlock, byChangePoint = getSecondsBlockResponse()
   
   if byMinute:  
     print("\nData values will be changed when the mean value for any given minute of data differs by more than a specified percentage from the mean value")
@@ -2795,9 +3666,37 @@ def preProcessPhysiological(filename):
     print("\nData values will be changed when the mean value for any given block of seconds of data differs by more than a specified percentage from the mean value")
     print("for the data over a period of one block of seconds, from 2 blocks of seconds earlier.")
   
-  percent = getPercent("\nEnter the percentage difference value that results in the data being changed in the range 5 to 95 (excluding the percentage sign. CR for default = 50%) : ",5,95,50)
+  if byChangePoint:
+    print("\nData values will be changed so that each change in the level of the data (where the mean value changes - a change point) is a step change.")
+    print("The values between two change points are all set to their mean value.")
+    settingName = "Penalty"
+    settings = getPercentList("\nEnter the change point penalty values in the range 0.5 to 100 - higher values find fewer change points - separated by commas (CR for default = 3) : ",0.5,100,3)
+    if perMinute:
+      minLength = getIntegerInput("\nEnter the minimum number of minutes between change points (CR for default = 2) : ",1,1440,2)
+    else:
+      minLength = getIntegerInput("\nEnter the minimum number of seconds between change points (CR for default = 30) : ",1,86400,30)
+      minLength = minLength / 60
+    minRecords = max(2, int(round(minLength * freq)))
+  else:
+    settingName = "Percentage"
+    settings = getPercentList("\nEnter the percentage difference values that result in the data being changed in the range 5 to 95, separated by commas (excluding the percentage sign. CR for default = 50%) : ",5,95,50)
   firstIsCsv = csvFile 
 
+# If there is more than one column of numeric data, ask the user which columns to process
+  if len(numericCols) > 1:
+    targetCols = selectPhysioColumns()
+  else:
+    targetCols = [int(numericCols[0])]
+
+# With more than one percentage (or penalty), ask whether to write an output file for each one, or a single file with the percentage in an extra column
+  stacked = False
+  if len(settings) > 1:
+    while True:
+      response = input("\nWrite an output file for each " + settingName.lower() + " (F), or a single output file with the " + settingName.lower() + " in the last column (S) (F/S) : ").upper()
+      if response in ["F","S"]:
+        stacked = response == "S"
+        break
+
 # Get the output filename  
   defaultFolder = os.path.dirname(filename)
   folder = selectFolder(defaultFolder,"\nSelect the folder to create the output files in (D) for - " + defaultFolder + " or select folder (S) (D/S) - ")
@@ -2805,89 +3704,263 @@ def preProcessPhysiological(filename):
   response = "C"
   while response == "C":
     newFile, fName = getNewFilename("",folder,"Enter output filename")
-    response = checkFileExists(newFile,False,False)
-
-# If there is more than one column of numeric data, ask the user which column to process
-  if len(numericCols) > 1:
-    targetCol = selectSingleColumn('\nEnter the number of the column to pre-process (CR for last column; first column is column 0) : ',True)
-  else:
-    targetCol = int(numericCols[0]) 
+    newFiles = getPercentFilenames(newFile,fName,settings,stacked)
+    for pFile in dict.fromkeys(newFiles.values()):
+      response = checkFileExists(pFile,False,False)
+      if response == "C":
+        break
 
 #------------------------------------------------------------------------------------------------------------------------------------------------------------------------      
-# Calculate the mean value (t1) for the selected column for each block of data. Compare it with the mean value from two blocks earlier (t3). If the percentage change   |
-# is greater than the percentage specified by the user (percent), then change the values in that column for the previous block to those of the current block.           |
+# Calculate the mean value (t1) for each selected column for each block of data. Compare it with the mean value from two blocks earlier (t3). If the percentage change |
+# is greater than a percentage specified by the user, then change the values in that column for the previous block to those of the current block.                     |
+# The blocks and their mean values are found once, and used for every percentage.                                                                                     |
+# For change points, the possible change points are found once for each column (with the lowest penalty), and those kept with each penalty are taken from them.       |
 #------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-  ix, t1, t2, t3, st1, st2 = 0, 0, 0, 0, 0, 0
-  stime = df.iloc[0,0]
-  dflen = len(df)-1
-  found = False
-  while ix < dflen: 
-    ix2, sumV = 0, 0  
-    st2 = st1
-    st1 = ix  
-    if byMinute:
-      while (stime.minute == df.iloc[ix,0].minute) and (ix < dflen):
-        sumV+=df.iloc[ix,targetCol]
-        ix2+=1
-        ix+=1  
-    elif byBlock:    
-      while (ix2 < perBlock) and (ix < dflen):
-        sumV+=df.iloc[ix,targetCol]
-        ix2+=1
-        ix+=1  
-    else:   
-      while ((df.iloc[ix,0]-stime).total_seconds() < secondsPerBlock) and (ix < dflen):
-        sumV+=df.iloc[ix,targetCol]
-        ix2+=1
-        ix+=1  
-
-    if ix2 > 0:
-      t3 = t2
-      t2 = t1
-      t1 = sumV/ix2  
-      stime = df.iloc[ix,0]
-      if t3 > 0:
-        percentChange = (abs(t1-t3)/t3)*100
-        if percentChange > percent:
-          print("Changing data at - ",df.iloc[st2][0])
-          ix3 = 0
-          while st2 < st1:
-            df.iat[st2,targetCol] = df.iloc[st1+ix3][targetCol]
-            st2+=1
-            ix3+=1
-            found = True
-
-# If no changes were made, with the given percentage specified by the user, stop.
-  if not found:
-    print("\nNo data was changed at the specified percentage. Terminating.")
+  values = {col: df.iloc[:,col].to_numpy() for col in targetCols}
+  if byChangePoint:
+    penalties = {col: getChangePointPenalty(values[col]) for col in targetCols}
+    trees = {col: getChangePointTree(values[col],minRecords,penalties[col]*min(settings)) for col in targetCols}
   else:
+    starts = getPhysioBlockStarts(df.iloc[:,0],byMinute,bySeconds,perBlock,secondsPerBlock)
+    means = {col: getBlockMeans(values[col],starts) for col in targetCols}
+
+  plotValues = None
+  for setting in settings:
+    settingText = '{:g}'.format(setting) + ("" if byChangePoint else "%")
+    found = False
+    newValues = {}
+    for col in targetCols:
+      if byChangePoint:
+        changed = getChangePoints(trees[col],penalties[col]*setting)
+      else:
+        changed = getStepChanges(means[col],setting)
+      if len(changed) > 0 and len(settings) + len(targetCols) > 2:
+        print("\n",settingName," ",'{:g}'.format(setting),", column ",col," (",df.columns[col],")",sep="")
+      if byChangePoint:
+        for k in changed:
+          print("Change point at - ",df.iloc[k,0])
+      else:
+        for k in changed:
+          print("Changing data at - ",df.iloc[starts[k-1],0])
+      if len(changed) == 0:
+        newValues[col] = values[col]
+      elif byChangePoint:
+        found = True
+        newValues[col] = snapToSegments(values[col],changed)
+      else:
+        found = True
+        newValues[col] = backfillBlocks(values[col],starts,changed)
 
-# Write the changed data to the output file chosen by the user
-    writeOutputFile(df,True,newFile,True)
+# If no changes were made with this percentage, there is nothing to write for it
+    if not found:
+      print("\nNo data was changed at ",settingText,".",sep="")
+      continue
+    if plotValues is None:
+      plotValues = newValues
+
+# Write the changed data to the output file for this percentage (the input values are put back afterwards, ready for the next percentage)
+    for col in targetCols:
+      df[df.columns[col]] = newValues[col]
+    if stacked:
+      df[settingName] = setting
+    writeOutputFile(df,newFiles[setting],not stacked or plotValues is newValues)
+    if stacked:
+      del df[settingName]
+    for col in targetCols:
+      df[df.columns[col]] = values[col]
+  closeOutputFiles()
+
+# If no changes were made, with any of the percentages specified by the user, stop.
+  if plotValues is None:
+    print("\nNo data was changed at the specified " + settingName.lower() + ". Terminating.")
+  else:
 
-# Display a plot of the changed data (just the timestamp and column that was changed)
-    numericCols = [0,targetCol]
+# Display a plot of the changed data (just the timestamp and the columns that were changed), for the first percentage that changed the data
+    for col in targetCols:
+      df[df.columns[col]] = plotValues[col]
+    numericCols = [0] + targetCols
     plotData2(df,False)
 
+#---------------------------------------------------------------------------------------------------------------------------------------------------
+# Ask the user which numeric columns to pre-process for physiological data. They can specify single columns, or column ranges, as for 'selectColumns'. |
+#---------------------------------------------------------------------------------------------------------------------------------------------------
+def selectPhysioColumns():
+  while True:
+    targetCols = selectColumns(df.iloc[5],"\nEnter the numbers of the columns to pre-process, eg 1-3,5 (CR for all numeric columns; first column is column 0) : ",1)
+    targetCols = [col for col in dict.fromkeys(targetCols) if col in numericCols]
+    if len(targetCols) > 0:
+      return targetCols
+    print("Select at least one numeric column.")
+
+# Get the output filename for each percentage - the filename entered with '_' and the percentage added (before the extension), or the filename entered for all
+# the percentages if they are written to a single file (or there is only one percentage)
+def getPercentFilenames(newFile,fName,percents,stacked):
+  if stacked or len(percents) == 1:
+    return {percent: newFile for percent in percents}
+  iPath = os.path.dirname(newFile) + "/"
+  extension = newFile[len(iPath + fName):]
+  return {percent: iPath + fName + "_" + '{:g}'.format(percent) + extension for percent in percents}
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Find the first record of each block of data for 'preProcessPhysiological'. Blocks cover all but the last record. A block is either the records with the     |
+# same 'minute' value, 'perBlock' records, or the records from the first one up to (not including) the first whose timestamp is 'secondsPerBlock' or more    |
+# later.                                                                                                                                                      |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getPhysioBlockStarts(times,byMinute,bySeconds,perBlock,secondsPerBlock):
+  dflen = len(times) - 1
+  if dflen <= 0:
+    return np.zeros(0, dtype=np.int64)
+  if byMinute:
+    minutes = times.dt.minute.to_numpy()[:dflen]
+    return np.flatnonzero(np.r_[True, minutes[1:] != minutes[:-1]])
+  if not bySeconds:
+    return np.arange(0, dflen, perBlock)
+
+# Blocks of seconds - the first record at or after the end of a block is found from the running maximum of the timestamps (unless timestamps earlier in
+# the file are already past the end of the block, when the records are checked one at a time)
+  ns = times.to_numpy().astype('datetime64[ns]').view(np.int64)
+  runningMax = np.maximum.accumulate(ns)
+  blockLength = secondsPerBlock * 10**9
+  starts, ix = [], 0
+  while ix < dflen:
+    starts.append(ix)
+    blockEnd = ns[ix] + blockLength
+    if ix == 0 or runningMax[ix-1] < blockEnd:
+      ix = int(np.searchsorted(runningMax, blockEnd, side='left'))
+    else:
+      ix += 1
+      while ix < dflen and ns[ix] < blockEnd:
+        ix += 1
+  return np.array(starts, dtype=np.int64)
+
+# Get the mean value of each block
+def getBlockMeans(values,starts):
+  if len(starts) == 0:
+    return np.zeros(0)
+  blockIds = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(values) - 1]))
+  return np.bincount(blockIds, weights=values[:len(blockIds)].astype(float)) / np.bincount(blockIds)
+
+# Get the numbers of the blocks whose mean value differs from the mean of the block two earlier by more than 'percent' percent (where that earlier mean is positive)
+def getStepChanges(means,percent):
+  if len(means) < 3:
+    return np.zeros(0, dtype=np.int64)
+  t1, t3 = means[2:], means[:-2]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    changed = (t3 > 0) & ((np.abs(t1 - t3) / t3) * 100 > percent)
+  return np.flatnonzero(changed) + 2
+
+# Replace the values of the block before each changed block with the values starting at the changed block (values are always taken from the unchanged data)
+def backfillBlocks(values,starts,changed):
+  blockLengths = starts[changed] - starts[changed-1]
+  targets = np.repeat(starts[changed-1], blockLengths) + (np.arange(blockLengths.sum()) - np.repeat(np.cumsum(blockLengths) - blockLengths, blockLengths))
+  sources = targets + np.repeat(blockLengths, blockLengths)
+  inRange = sources < len(values)
+  newValues = values.copy()
+  newValues[targets[inRange]] = values[sources[inRange]]
+  return newValues
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Find change points in a column of data for 'preProcessPhysiological' by binary segmentation - the records are split at the point that most reduces the sum  |
+# of the squared differences of the values from the mean of each part (found for every point at once from the cumulative sum of the values), as long as that  |
+# reduction is greater than the penalty, and each part is then split in the same way. No part is shorter than 'minRecords' records. Each level of splits is   |
+# one pass through the data, so the time taken is O(n log k) for k change points when the splits are even, and up to O(n k) when they are lopsided.           |
+# The penalty is the variance of the noise in the data times the log of the number of records, times the value chosen by the user. The noise is estimated from|
+# the median absolute change from one reading to the next, after collapsing runs of repeated values (so upsampled data, which repeats each reading, doesn't   |
+# give an estimate of zero) - the penalty is then scaled by the mean run length, as a step's reduction grows with the number of records on each side of it.   |
+# Splits only depend on the data, so the tree of splits found with the lowest penalty holds the splits for every higher one.                                  |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getChangePointPenalty(values):
+  x = values.astype(float)
+  runStarts = np.flatnonzero(np.r_[True, x[1:] != x[:-1]])
+  steps = np.diff(x[runStarts])
+  if len(steps) == 0:
+    return 0.0
+  sigma = 1.4826 * np.median(np.abs(steps - np.median(steps))) / np.sqrt(2)
+  if sigma == 0:
+    sigma = np.std(steps) / np.sqrt(2)
+  return sigma**2 * (len(x) / len(runStarts)) * np.log(len(runStarts))
+
+def getChangePointTree(values,minRecords,penalty):
+  x = values.astype(float)
+  splits, gains, parents = [], [], []
+  segments = [(0, len(x), -1)]
+  while len(segments) > 0:
+    a, b, parent = segments.pop()
+    length = b - a
+    if length < 2*minRecords:
+      continue
+    seg = x[a:b]
+    sums = np.cumsum(seg - seg.mean())[minRecords-1:length-minRecords]
+    left = np.arange(minRecords, length-minRecords+1)
+    gain = sums * sums * length / (left * (length - left))
+    k = int(np.argmax(gain))
+    if not gain[k] > penalty:
+      continue
+    splits.append(a + int(left[k]))
+    gains.append(gain[k])
+    parents.append(parent)
+    segments.append((a, splits[-1], len(splits)-1))
+    segments.append((splits[-1], b, len(splits)-1))
+  return np.array(splits, dtype=np.int64), np.array(gains), np.array(parents, dtype=np.int64)
+
+# Get the change points (the first record after each change) kept with a penalty - those whose split, and every split above it, reduced the squared differences by more than it
+def getChangePoints(tree,penalty):
+  splits, gains, parents = tree
+  kept = gains > penalty
+  for i in range(len(splits)):
+    if kept[i] and parents[i] >= 0:
+      kept[i] = kept[parents[i]]
+  return np.sort(splits[kept])
+
+# Set the values between each change point to their mean value (rounded for integer data)
+def snapToSegments(values,changePoints):
+  segIds = np.repeat(np.arange(len(changePoints)+1), np.diff(np.r_[0, changePoints, len(values)]))
+  means = np.bincount(segIds, weights=values.astype(float)) / np.bincount(segIds)
+  if np.issubdtype(values.dtype, np.integer):
+    return np.rint(means).astype(values.dtype)[segIds]
+  return means[segIds]
+
 # Write a dataframe to the output file chosen by the user. The file type will be the same as the input file type.
-# For an Excel output file, if more than one dataframe is being written, 'startRow' is set to the end of the file after the previous dataframe was written,
-# to append rows, rather than overwrite (if the user is overwriting the file it will have been previously deleted).
-def writeOutputFile(df,firstFile,newFile,writeMessage):
+# A csv output file is opened the first time it is written to (appending to it if it already exists), through a large write buffer and, if the user chose it, 
+# gzip or zstandard compression. Numeric values are rounded to the number of decimal places chosen by the user. 
+# An Excel output file is opened the first time it is written to, in xlsxwriter's 'constant memory' mode (rows are streamed to disk as they are written). 
+# xlsxwriter can only create a new workbook, so an Excel file that already exists is replaced rather than appended to.
+# Each file is kept open in 'outputWriters' (with the next row to write to for Excel), so further dataframes are appended after the previous one. 
+# 'closeOutputFiles' completes them.
+def writeOutputFile(df,newFile,writeMessage):
   global firstIsCsv
   if writeMessage: 
     print("\nWriting to ",newFile)
   if firstIsCsv:
-    df.to_csv(newFile, encoding='utf-8', index=False, header=False,mode='a', quotechar=' ')  
+    if newFile not in outputWriters:
+      handles = [open(newFile, 'ab', buffering=outputBufferSize*1024*1024)]
+      if csvOutputOptions['compression'] == "gzip":
+        handles.insert(0, gzip.GzipFile(fileobj=handles[0], mode='ab', compresslevel=6))
+      elif csvOutputOptions['compression'] == "zstd":
+        handles.insert(0, zstandard.ZstdCompressor().stream_writer(handles[0]))
+      handles.insert(0, io.TextIOWrapper(handles[0], encoding='utf-8', newline=''))
+      outputWriters[newFile] = {'handles': handles}
+    if csvOutputOptions['decimals'] is not None:
+      df = df.round(csvOutputOptions['decimals'])
+    df.to_csv(outputWriters[newFile]['handles'][0], index=False, header=False, quotechar=' ')
   else:
-    writer = pd.ExcelWriter(newFile, engine='openpyxl')
-    if firstFile:
-      startRow = 0
+    if newFile not in outputWriters:
+      workbook = xlsxwriter.Workbook(newFile, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss', 'nan_inf_to_errors': True})
+      outputWriters[newFile] = {'workbook': workbook, 'sheet': workbook.add_worksheet('Sheet1'), 'row': 0}
+    writer = outputWriters[newFile]
+    for values in df.itertuples(index=False, name=None):
+      writer['sheet'].write_row(writer['row'], 0, values)
+      writer['row']+=1
+
+# Close all the output files that are open
+def closeOutputFiles():
+  for newFile in list(outputWriters):
+    writer = outputWriters.pop(newFile)
+    if 'workbook' in writer:
+      writer['workbook'].close()
     else:
-      writer.book = load_workbook(newFile)
-      writer.sheets =  {ws.title: ws for ws in writer.book.worksheets}      
-      startRow = (writer.sheets['Sheet1'].max_row)+1
-    df.to_excel(writer, sheet_name='Sheet1', index=False,header=False,startrow=startRow)
-    writer.save()
+      for handle in writer['handles']:
+        handle.close()
 
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------
 # Combine multiple files into one output file, by appending each file after the first one to the end of the output file.
@@ -2909,11 +3982,16 @@ def combineFiles(xfilename):
     newFile, fName = getNewFilename("",folder,"Enter output filename")
     response = checkFileExists(newFile,False,False)
 
-# Write the first file to the output file
-  writeOutputFile(df,True,newFile,True)
+# Write the first file to the output file, and get the last record from it
+  saveLast = writeCombinedChunks(getFileChunks(xfilename),None,True)
 
-# Get the last record from the first input file. 
-  saveFirst, saveLast = getFirstLastRecords(df)
+# The rest of the input files can be listed in a text file, or matched by a pattern, rather than selected one at a time
+  response = ""
+  while response not in ["O","L","P"]:
+    response = input("\nSelect the next input files one at a time (O), from a text file listing them (L), or by a pattern matching them eg C:/data/*.csv (P) (O/L/P) : ").upper()
+  if response != "O":
+    combineFileList(getCombineFileList(xfilename,response),saveLast)
+    return
  
 # For each subsequent input file append all the records to the end of the output file, replacing the timestamp with one that begins 1 second/minute after the end of the
 # previous input file, and incrementing it by one second/minute every time the second/minute value changes in the input timestamp.
@@ -2923,7 +4001,7 @@ def combineFiles(xfilename):
 # Get the next input file  
     print("\nSelect next input data file ('Cancel' when finished entering files)")
     root = Tk(); root.withdraw()
-    filename = fd.askopenfilename(filetypes=[("Input file", "*.csv .xls .xlsx")])
+    filename = fd.askopenfilename(filetypes=[("Input file", "*.csv .csv.gz .csv.zst .csv.bz2 .csv.xz .zip .xls .xlsx .cwa")])
     root.destroy()
     if filename != "":
       print("\nFile selected - ",filename)
@@ -2933,26 +4011,148 @@ def combineFiles(xfilename):
       else:
         askUser = True  
         
-      _ , inputFileType = os.path.splitext(filename)
-      if inputFileType == ".csv":
-        csvFile = True
-      else:  
-        csvFile = False
+      setInputFileType(filename)
+      try:
+        getData(filename)
+      except ValueError as e:
+        print("\n",os.path.basename(filename)," - not combined - ",e,sep="")
+        continue
+      firstRecord, lastRecord = getFirstLastRecords(df)
 
+# Write the input file to the output file (append to the end), with the timestamps adjusted to follow on from the previous file
+      saveLast = writeCombinedChunks(getFileChunks(filename),getCombineOffset(saveLast,firstRecord,perMinute),True)
+
+# Find the amount to adjust the timestamp values of an input file by, so they begin 1 second/minute after the last timestamp of the previous file ('saveLast')
+def getCombineOffset(saveLast,firstRecord,perMinute):
+  if perMinute:
+    numMinutes = int((saveLast - firstRecord).total_seconds()/60)+1
+    return pd.Timedelta(minutes=numMinutes)     
+  numSeconds = int((saveLast - firstRecord).total_seconds())+1
+  return pd.Timedelta(seconds=numSeconds)     
+
+# The records of the input file just loaded by 'getData' - the first chunk (in 'df'), then the rest of the chunks for a csv file read in chunks
+def getFileChunks(filename):
+  yield df
+  if streamInput:
+    yield from getDataChunks(filename)
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Append the chunks of an input file to the combined output file, adding 'offset' to their timestamps. Each chunk is written through the open output file as |
+# soon as it has been read, so only one chunk is held in memory however large the input files are. Returns the last timestamp written.                       |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+def writeCombinedChunks(chunks,offset,writeMessage):
+  for dfc in chunks:
+    if offset is not None:
+      dfc['Time'] = dfc['Time'] + offset
+    writeOutputFile(dfc,newFile,writeMessage)
+    writeMessage = False
+    lastRecord = dfc['Time'].iloc[-1]
+  return lastRecord
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Get the rest of the input files to combine, in order - from a text file listing them, one per line (L), or all the files matching a pattern, in name order |
+# (P). Relative names are taken to be in the folder of the text file (L) or the first input file (P). Blank lines, lines starting with '#', the first input  |
+# file and the output file are left out.                                                                                                                     |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------
+def getCombineFileList(xfilename,response):
+  skipFiles = [os.path.abspath(xfilename), os.path.abspath(newFile)]
+  while True:
+    if response == "L":
+      listFile = input("\nEnter the name of the text file listing the input files (one per line) : ").strip()
+      if checkFileExists(listFile,False,True) == "N":
+        continue
+      listFolder = os.path.dirname(os.path.abspath(listFile))
+      with open(listFile) as f:
+        lines = [line.strip() for line in f]
+      files = [os.path.join(listFolder, os.path.expanduser(line)) for line in lines if line != "" and not line.startswith("#")]
+      missing = [f for f in files if not os.path.isfile(f)]
+      if len(missing) > 0:
+        print("\nThese input files do not exist - ")
+        for f in missing:
+          print(f)
+        continue
+    else:
+      pattern = os.path.join(os.path.dirname(os.path.abspath(xfilename)), os.path.expanduser(input("\nEnter the pattern matching the input files, eg C:/data/*.csv : ").strip()))
+      files = sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+    files = [f for f in files if os.path.abspath(f) not in skipFiles]
+    if len(files) > 0:
+      print("\n",len(files)," input files to combine with the first one")
+      return files
+    print("\nNo input files found")
+
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Combine a list of input files with the first one (already written to the output file). The files are read by a pool of 'combineWorkers' processes, using the   |
+# responses given for the first file (columns to process, switching month and day, scaling and proportion of records to keep). Each worker writes the records it  |
+# has read to a temporary file. The files are appended to the output file in order, as soon as each one (and every file before it) has been read, with the        |
+# timestamps adjusted in the same way as for files selected one at a time. No more than twice as many files as there are workers are read ahead of the one       |
+# being written, so only that many temporary files are held on disk at once. The number of records and MB read per second, and records written per second, are   |
+# shown for each file.                                                                                                                                           |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def combineFileList(files,saveLast):
+  settings = {name: globals().get(name) for name in ('purpose', 'smd', 'si', 'scalePlot', 'dFrac', 'perSec', 'colNums', 'scaleCols', 'firstIsCsv', 'csvOutputOptions')}
+  settings.update({'askUser': False, 'reuseColumns': True})
+  tempFolder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(newFile)))
+
+  print("\nPlease wait, combining input files ...")
+  totalRecords, numFiles, startTime = 0, 0, time.time()
+  try:
+    with ProcessPoolExecutor(max_workers=combineWorkers, mp_context=multiprocessing.get_context("spawn")) as executor:
+# Files are only read up to 'maxReadAhead' files ahead of the one being written, so the temporary files waiting to be written don't fill the disk
+      maxReadAhead = 2 * (combineWorkers or os.cpu_count() or 1)
+      futures = {}
+      for ix in range(len(files)):
+        for iy in range(ix, min(ix + maxReadAhead, len(files))):
+          if iy not in futures:
+            futures[iy] = executor.submit(readCombineFile, files[iy], os.path.join(tempFolder, str(iy) + ".tmp"), settings)
+        filename, result = futures.pop(ix).result()
+        if isinstance(result, str):
+          print(os.path.basename(filename)," - ",result,sep="")
+          continue
+        writeStart = time.time()
+        saveLast = writeCombinedChunks(readTempChunks(result['tempFile']),getCombineOffset(saveLast,result['firstRecord'],result['perMinute']),False)
+        numRecords = result['records']
+        writeSeconds = max(time.time() - writeStart, 1e-6)
+        os.remove(result['tempFile'])
+        totalRecords += numRecords
+        numFiles += 1
+        print(os.path.basename(filename)," - ",numRecords," records. Read at ",int(numRecords/result['seconds'])," records/s (",round(result['size']/1024/1024/result['seconds'],1),
+              " MB/s), written at ",int(numRecords/writeSeconds)," records/s",sep="")
+  finally:
+    shutil.rmtree(tempFolder, ignore_errors=True)
+  print("\n",totalRecords," records from ",numFiles," files added to ",newFile," in ",round(time.time()-startTime,1)," seconds",sep="")
+
+# Read one input file in a worker process started by 'combineFileList', and write its (processed) chunks to a temporary file. Output from the processing is held
+# back, and the last message from it is returned if the file could not be read.
+def readCombineFile(filename,tempFile,settings):
+  globals().update(settings)
+  output = io.StringIO()
+  try:
+    with contextlib.redirect_stdout(output):
+      loadLibraries()
+      startTime = time.time()
+      setInputFileType(filename)
       getData(filename)
-      firstRecord, lastRecord = getFirstLastRecords(df)
-      
-# Adjust the timestamp values by the required amount      
-      if perMinute:
-        numMinutes = int((saveLast - firstRecord).total_seconds()/60)+1
-        df['Time'] = df['Time'] + pd.Timedelta(minutes=numMinutes)     
-      else:     
-        numSeconds = int((saveLast - firstRecord).total_seconds())+1
-        df['Time'] = df['Time'] + pd.Timedelta(seconds=numSeconds)     
-
-# Write the input file to the output file (append to the end)      
-      writeOutputFile(df,False,newFile,True)
-      saveFirst, saveLast = getFirstLastRecords(df)
+      numRecords = 0
+      with open(tempFile, "wb") as f:
+        for dfc in getFileChunks(filename):
+          pickle.dump(dfc, f, protocol=pickle.HIGHEST_PROTOCOL)
+          numRecords += len(dfc)
+      return filename, {'tempFile': tempFile, 'firstRecord': df.iloc[0,0], 'perMinute': perMinute, 'records': numRecords, 'size': os.path.getsize(filename),
+                        'seconds': max(time.time() - startTime, 1e-6)}
+  except SystemExit:
+    pass
+  except Exception as e:
+    return filename, "not combined - " + str(e)
+  return filename, "not combined - " + getLastMessage(output)
+
+# The chunks written to a temporary file by 'readCombineFile'
+def readTempChunks(tempFile):
+  with open(tempFile, "rb") as f:
+    while True:
+      try:
+        yield pickle.load(f)
+      except EOFError:
+        return
 
 #---------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 # When merging two files, for each record append the required columns from the second file to those from the first file. If the frequency of the second file is lower      |
@@ -3149,7 +4349,7 @@ def mergeFiles(filename1):
 
 # Write the output file
   df = pd.DataFrame(outRecs)
-  writeOutputFile(df,True,newFile,True)
+  writeOutputFile(df,newFile,True)
 
 #-------------------------------------------------------
 # Print the help text to the user's console, or a file |
@@ -3199,18 +4399,22 @@ def setProcessingType():
     
   return performProcessing
 
-#--------------------------------------------------------------------------------------------------------
-# Plot a histogram of selected input data (numeric only). The user specifies the number of bins to use. |
-#--------------------------------------------------------------------------------------------------------
+#--------------------------------------------------------------------------------------------------------------------------------------------------------
+# Plot a histogram of selected input data (numeric only). The user specifies the number of bins to use. The counts in each bin are found first (see         |
+# 'getHistogramCounts'), a chunk at a time for a large file, and only the counts are plotted. The counts can also be saved to an output file.               |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------
 def showHistogram(dummy):
-  global df
-  df = plotData(df,0,0,True,False,'Select the start and end times of the data of interest using mouse left-click. Finish input with mouse right-click. Remove entry with delete/backspace.')    
+  global df, firstIsCsv
+  firstIsCsv = csvFile
+
+# For a large file read in chunks only the first chunk can be plotted - the user can select the data of interest from it, or use the whole file
+  sTime, eTime = None, None
+  if not streamInput or getYNInput("\nLarge file - select the start and end times of the data of interest from a plot of the first " + str(chunkSize) + " records (Y) or use the whole file (N)? Y/N - "):
+    df = plotData(df,0,0,True,False,'Select the start and end times of the data of interest using mouse left-click. Finish input with mouse right-click. Remove entry with delete/backspace.')    
+    sTime, eTime = datetime.strptime(startTime,dForm), datetime.strptime(stopTime,dForm)
 
   numBins = getIntegerInput("\nEnter the number of bins to use in the range 2 to 100 (CR for default = 10) : ",2,100,10)
   cls = list(df.iloc[:,numericCols])
-  clsdf = []
-  for cl in cls:
-    clsdf.append(df[cl])
 
   txt = "\nChange plot legend (currently - " + str(cls) + ")? Y/N - "    
   if getYNInput(txt):
@@ -3232,16 +4436,77 @@ def showHistogram(dummy):
     print(" ")
     while len(pltTitle) == 0:
         pltTitle = input("Enter plot title - ")
-    plt.title(pltTitle)
-    
+
+  print("\nCounting values ...")
+  edges, counts = getHistogramCounts(numBins,sTime,eTime)
+  if edges is None:
+    print("\nNo data records between the selected start and end times.")
+    return
+
+# Save the counts if the user wants them, with the bin boundaries and a column for each variable
+  if getYNInput("\nSave the counts in each bin to an output file? Y/N - "):
+    defaultFolder = os.path.dirname(filename)
+    folder = selectFolder(defaultFolder,"\nSelect the folder to create the output file in (D) for - " + defaultFolder + " or select folder (S) (D/S) - ")
+    defaultName = getRecordingName(filename) + "_histogram"
+    response = "C"
+    while response == "C":
+      histFile, fName = getNewFilename(defaultName,folder,"Enter output filename (CR for " + defaultName + ")")
+      response = checkFileExists(histFile,False,False)
+    histCounts = pd.DataFrame({'Bin start': edges[:-1], 'Bin end': edges[1:]})
+    for i in range(len(pltLegend)):
+      histCounts[pltLegend[i]] = counts[i]
+    writeOutputFile(pd.DataFrame([list(histCounts.columns)]),histFile,True)
+    writeOutputFile(histCounts,histFile,False)
+    closeOutputFiles()
+
+# Plot the counts - each variable's counts are the weights of one value at the centre of each bin
+  centres = (edges[:-1] + edges[1:]) / 2
   plt.style.use('seaborn-deep')
-  plt.hist(clsdf, bins=numBins)  # density=False would make counts
+  if pltTitle != "":
+    plt.title(pltTitle)
+  plt.hist([centres] * len(counts), bins=edges, weights=list(counts))
   plt.ylabel('Frequency')
   plt.xlabel('Value')
     
   plt.legend(pltLegend)
   plt.show()
 
+#--------------------------------------------------------------------------------------------------------------------------------------------------------
+# Count the values of each numeric column in 'numBins' equal bins, shared by all the columns. The bin edges are set from the minimum and maximum values,  |
+# then the counts for each chunk of data are added up with 'np.histogram'. For a large file read in chunks this takes two passes through the file - one   |
+# for the minimum and maximum, one for the counts - and only one chunk is in memory at a time. Returns the bin edges and an array of counts for each      |
+# column (or None, None if there is no data).                                                                                                            |
+#--------------------------------------------------------------------------------------------------------------------------------------------------------
+def getHistogramCounts(numBins,sTime,eTime):
+  low, high = np.inf, -np.inf
+  for values in getHistogramChunks(sTime,eTime):
+    if np.isfinite(values).any():
+      low, high = min(low, np.nanmin(values)), max(high, np.nanmax(values))
+  if low > high:
+    return None, None
+  if low == high:
+    low, high = low - 0.5, high + 0.5
+
+  counts = np.zeros((len(numericCols), numBins), dtype=np.int64)
+  for values in getHistogramChunks(sTime,eTime):
+    for i in range(len(numericCols)):
+      counts[i] += np.histogram(values[:,i], bins=numBins, range=(low, high))[0]
+  return np.linspace(low, high, numBins + 1), counts
+
+# Provide the numeric values to count, from 'df' and then (for a large file) from each of the remaining chunks of the file, between the start and end times
+# selected by the user (if any)
+def getHistogramChunks(sTime,eTime):
+  if len(df) > 0:
+    yield df.iloc[:,numericCols].to_numpy(dtype=float)
+  if streamInput:
+    for dfc in getDataChunks(filename):
+      if sTime is not None:
+        if dfc['Time'].iloc[0] >= eTime:
+          break
+        dfc = dfc.loc[(dfc['Time'] >= sTime) & (dfc['Time'] < eTime)]
+      if len(dfc) > 0:
+        yield dfc.iloc[:,numericCols].to_numpy(dtype=float)
+
 #-------------------
 # End of functions |
 #-------------------
@@ -3254,42 +4519,46 @@ processingDone = []
 firstRun = True
 configChange = False
 
+# The main processing only runs when the code is run directly, not when it is imported by the worker processes used to label a folder of recordings
+if __name__ == "__main__":
 # Keep looping, performing required processing until the user selects 'exit'.
-while True:
+  while True:
 # Initialise variables
-  sTimex, eTimex, perSec = 0, 0, 0
-  startTime, hasHeader, headers, dForm, freq, numCols, getRms, askCols, askUser, smd, si = 0, False, "", "", 0, 0, False, True, True, False, ""
+    sTimex, eTimex, perSec = 0, 0, 0
+    startTime, hasHeader, headers, dForm, freq, numCols, features, askCols, askUser, smd, si = 0, False, "", "", 0, 0, [], True, True, False, ""
+    csvOutputOptions, reuseColumns = None, False
 
 # Get the contents of the config file 'sensorcodeConfigFile.txt' (or create it if it doesn't exist)
-  if firstRun or configChange:
-    getConfigs("")
-    configChange = False
+    if firstRun or configChange:
+      getConfigs("")
+      configChange = False
     
 # Ask the user what processing they are performing 
-  print("\nSelect required processing : ")
-  options = setupList("Purpose") 
-  purpose = letUserPick(options).upper() 
+    print("\nSelect required processing : ")
+    options = setupList("Purpose") 
+    purpose = letUserPick(options).upper() 
 
-  performProcessing = setProcessingType()
+    performProcessing = setProcessingType()
 
-  if performProcessing == "printHelpText":
-    filename = "dummy"
-  else:  
+    if performProcessing == "printHelpText":
+      filename = "dummy"
+    else:  
 # Load required run time libraries
-    if performProcessing not in processingDone:
-      loadLibraries()
-      processingDone.append(performProcessing)
+      if performProcessing not in processingDone:
+        loadLibraries()
+        processingDone.append(performProcessing)
 
 # Get the (first) input file from the user
-    if ("Combine" in purpose) or ("Merge" in purpose):
-      filename = getInputFile(purpose,"\nSelect first input data file")
-    else:
-      filename = getInputFile(purpose,"\nSelect input data file")
+      if ("Combine" in purpose) or ("Merge" in purpose):
+        filename = getInputFile(purpose,"\nSelect first input data file")
+      else:
+        filename = getInputFile(purpose,"\nSelect input data file")
       
-    firstRun = False
+      firstRun = False
     
 # Perform the required processing, as requested by the user
-  eval(performProcessing + "(filename)")
+    eval(performProcessing + "(filename)")
+    closeOutputFiles()
   
 #--------------
 # End of code |